@@ -0,0 +1,76 @@
+"""ASGI entry point serving the same webhook routes as main.py's Flask app.
+
+    uvicorn asgi:app --host 0.0.0.0 --port 8000
+
+The webhook handler only queues the update, so it never holds a worker thread
+while a broadcast or Firestore write runs. Run a single uvicorn worker: each
+worker is a separate process with its own sessions, logins, update queue,
+de-duplication and running broadcast, and session_backend=sqlite does not
+close that gap (sessions are read once per process and the broadcast flags are
+not persisted), so a /terminate landing on another worker would not stop the
+broadcast. More than one worker is unsupported until that state is shared.
+
+Point the platform's readiness probe at /ready rather than /health: it answers
+503 until the worker's Firestore client and caches are warm.
+"""
+import asyncio
+import os
+import re
+
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse
+
+import main
+
+app = FastAPI(title='WappSender', docs_url=None, redoc_url=None, openapi_url=None)
+
+
+@app.post('/')
+async def webhook_post(request: Request):
+    main.enqueue_update(await request.json())
+    return {'status': 'ok'}
+
+
+@app.post('/ultramsg')
+async def ultramsg_webhook(request: Request):
+    if not main.delivery_op['enabled']:
+        raise HTTPException(status_code=404)
+    if not main.delivery_authorized(request.query_params.get('token')):
+        raise HTTPException(status_code=403)
+    try:
+        event = await request.json()
+    except ValueError:
+        event = {}
+    await asyncio.to_thread(main.record_delivery, event)
+    return {'status': 'ok'}
+
+
+@app.get('/media/{name}')
+@app.head('/media/{name}')
+async def media_file(name: str):
+    path = os.path.join(os.path.abspath(main.media_op['cache_dir']), name)
+    if not re.fullmatch(r'[0-9a-f]{64}(\.[0-9a-z]+)?', name) or not os.path.isfile(path):
+        raise HTTPException(status_code=404)
+    return FileResponse(path, headers={'Cache-Control': 'public, max-age=86400'})
+
+
+@app.get('/metrics', response_class=PlainTextResponse)
+async def metrics():
+    return PlainTextResponse(main.render_metrics(), media_type='text/plain; version=0.0.4')
+
+
+@app.get('/health')
+async def health_check():
+    return main.health_status()
+
+
+@app.get('/ready')
+async def ready_check():
+    status = main.readiness_status()
+    return JSONResponse(status, status_code=200 if status['ready'] else 503)
+
+
+@app.get('/clear')
+async def cache_clear():
+    # reloading talks to UltraMsg and Firestore, keep it off the event loop
+    return await asyncio.to_thread(main.reload_caches)
@@ -0,0 +1,322 @@
+"""Load benchmark for the send path, run against the local fake API in fake_api.py.
+
+    python benchmark.py --groups 1000 --files 5 --latency 0.05
+
+Runs main.py's broadcast/send_in_background/terminate flows without touching
+the real UltraMsg instance, Telegram or Firestore, and reports messages/sec,
+p50/p99 request latency and peak resident memory after each scenario, plus
+the cold start: how long importing main.py takes and how long until its
+readiness check reports the Firestore client and groups cache warm.
+
+With --check it also works as a regression test, most useful together with
+--error-rate or --rate-limit: every scenario has to finish within --timeout,
+no group may be sent the same message twice, every group the job
+checkpointed as sent must have received all of its messages, every other
+group must be named in what the operator was told, and the job must not
+end up 'failed'.
+
+    python benchmark.py --groups 100 --files 3 --error-rate 0.02 --check
+"""
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import resource
+
+from urllib.parse import quote
+from urllib.request import urlopen
+
+import fake_api
+
+SCENARIOS = ('text', 'single-file', 'multi-file', 'terminate')
+MESSAGE_ENDPOINTS = {f'ultramsg:messages/{endpoint}' for endpoint in ('chat', 'image', 'video', 'document', 'delete')}
+
+
+class FakeSnapshot:
+    def __init__(self, data:dict):
+        self.data = data
+
+    def get(self, field):
+        return self.data.get(field)
+
+
+class FakeDocument:
+    def __init__(self, store:dict, name:str):
+        self.store = store
+        self.name = name
+
+    def get(self):
+        return FakeSnapshot(dict(self.store.get(self.name, {})))
+
+    def update(self, fields:dict):
+        from firebase_admin.firestore import firestore as fs
+        data = self.store.setdefault(self.name, {})
+        for field, value in fields.items():
+            current = list(data.get(field) or [])
+            if isinstance(value, fs.ArrayUnion):
+                seen = set(current)
+                data[field] = current + [item for item in value.values if item not in seen and not seen.add(item)]
+            elif isinstance(value, fs.ArrayRemove):
+                removed = set(value.values)
+                data[field] = [item for item in current if item not in removed]
+            else:
+                data[field] = value
+
+    def set(self, fields:dict, merge:bool=False):
+        if not merge:
+            self.store[self.name] = {}
+        self.update(fields)
+
+
+class FakeBatch:
+    def __init__(self):
+        self.writes = []
+
+    def update(self, document:FakeDocument, fields:dict):
+        self.writes.append((document, fields))
+
+    def commit(self):
+        for document, fields in self.writes:
+            document.update(fields)
+
+
+class FakeFirestore:
+    """Just enough of the Firestore client for the documents main.py uses."""
+
+    def __init__(self):
+        self.store = {'exclude_user': {'ids': []}}
+
+    def collection(self, name:str):
+        return self
+
+    def document(self, name:str):
+        return FakeDocument(self.store, name)
+
+    def batch(self):
+        return FakeBatch()
+
+
+def start_fake_api(options:dict):
+    """Run fake_api.py in its own process so it doesn't compete with main.py for the GIL."""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_api.py'), '--port', str(port)]
+    for name, value in options.items():
+        command += [f"--{name.replace('_', '-')}", str(value)]
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    base_url = f'http://127.0.0.1:{port}'
+    deadline = time.monotonic() + 15
+    while True:
+        try:
+            fake_api_stats(base_url)
+            return process, base_url
+        except OSError:
+            if time.monotonic() > deadline or process.poll() is not None:
+                process.kill()
+                raise
+            time.sleep(0.1)
+
+
+def fake_api_stats(base_url:str) -> dict:
+    with urlopen(f'{base_url}/_stats', timeout=1) as response:
+        return json.load(response)
+
+
+def import_main(base_url:str, args):
+    """Import main.py wired to the fake API, then hand it an in-memory Firestore in place of the lazily built client."""
+    os.environ.update({
+        'ultramsg_api_base': base_url,
+        'telegram_api_base': base_url,
+        'instance': 'instance1',
+        'wapp_token': 'token',
+        'instances': ','.join(f'instance{index + 1}:token' for index in range(args.instances)),
+        'bot_token': 'token',
+        'jobs_db': os.path.join(tempfile.mkdtemp(prefix='wappsender-bench-'), 'jobs.db'),
+        'resume_jobs': '0',
+    })
+    for name, value in (('send_rate', args.send_rate), ('send_rate_max', args.send_rate),
+                        ('send_burst', args.send_rate), ('fanout_workers', args.fanout)):
+        os.environ.setdefault(name, str(value))
+
+    os.environ['warm_up'] = '0'  # started by hand once the in-memory Firestore is in place
+
+    start = time.perf_counter()
+    import main
+    import_seconds = time.perf_counter() - start
+    main.firestore_op['client'] = FakeFirestore()
+    return main, import_seconds
+
+
+def wait_ready(main, timeout:float=30) -> float:
+    """Poll main.py's readiness check the way a container probe would and return seconds until it reports ready."""
+    start = time.perf_counter()
+    while not main.readiness_status()['ready']:
+        if time.perf_counter() - start > timeout:
+            raise TimeoutError(f"not ready after {timeout:.0f}s: {main.warmup_op['errors']}")
+        time.sleep(0.01)
+    return time.perf_counter() - start
+
+
+def build_content(base_url:str, files:int) -> dict:
+    kinds = ('photos', 'videos', 'documents')
+    content = {'files': [], 'text': 'Benchmark caption'}
+    for index in range(files):
+        link = f'{base_url}/file/bottoken/documents/file_{index}.pdf'
+        kind = kinds[index % len(kinds)]
+        content['files'].append({'documents': {f'file_{index}': link}} if kind == 'documents' else {kind: link})
+    return content
+
+
+def percentile(values:list, fraction:float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def last_job_id(main) -> int:
+    with main.jobs_lock:
+        return main.jobs_db.execute('SELECT COALESCE(MAX(id), 0) FROM jobs').fetchone()[0]
+
+
+def check_delivery(main, base_url:str, session, content:dict, after_job:int, notices:list) -> dict:
+    """Compare what the fake API accepted under the scenario's job with the targets the job checkpointed as sent,
+    and look for every other target in the Telegram messages the operator got."""
+    job_id = last_job_id(main)
+    if content is None or job_id == after_job:
+        return {'duplicates': 0, 'short': 0, 'unreported': 0, 'status': None}
+    reference = quote(main.delivery_reference(session.chat_id, job_id))
+    with urlopen(f'{base_url}/_delivered?reference={reference}', timeout=5) as response:
+        delivered = json.load(response)
+    with main.jobs_lock:
+        targets = main.jobs_db.execute('SELECT target, status FROM job_targets WHERE job_id = ?', (job_id,)).fetchall()
+        status = main.jobs_db.execute('SELECT status FROM jobs WHERE id = ?', (job_id,)).fetchone()[0]
+    sent = [target for target, target_status in targets if target_status == 'sent']
+    told = '\n'.join(notices)
+    steps = main.group_steps(content) if len(content['files']) > 1 else 1  # text and single file go out as one message
+    return {
+        'duplicates': delivered['duplicates'],
+        'short': sum(delivered['targets'].get(target, 0) < steps for target in sent),
+        'unreported': sum(target_status != 'sent' and target not in told for target, target_status in targets),
+        'status': status,
+    }
+
+
+def run_scenario(main, name:str, base_url:str, args, latencies:list, notices:list) -> dict:
+    session = main.get_session(1)
+    targets = list(main.get_groups_dict().keys())[:args.groups]
+    content = None
+    if name == 'text':
+        content = {'files': [], 'text': 'Benchmark text'}
+    elif name == 'single-file':
+        content = build_content(base_url, 1)
+    elif name == 'multi-file':
+        content = build_content(base_url, args.files)
+    if content is not None:
+        action = lambda: main.send_in_background(targets, content, session, 'done')
+    else:
+        message_ids = [str(index) for index in range(args.groups * args.files)]
+        main.get_db().store[main.message_ids_document(session.chat_id)] = {'ids': message_ids}
+        action = lambda: main.terminate(session)
+
+    latencies.clear()
+    notices.clear()
+    after_job = last_job_id(main)
+    start = time.perf_counter()
+    worker = threading.Thread(target=action, name=f'benchmark-{name}', daemon=True)
+    worker.start()
+    worker.join(args.timeout)
+    elapsed = time.perf_counter() - start
+    finished = not worker.is_alive()
+
+    sends = [(elapsed_, failed) for endpoint, elapsed_, failed in latencies if endpoint in MESSAGE_ENDPOINTS]
+    send_latencies = [elapsed_ for elapsed_, _ in sends]
+    return {
+        'scenario': name,
+        'requests': len(send_latencies),
+        'errors': sum(failed for _, failed in sends),
+        'seconds': elapsed,
+        'per_second': len(send_latencies) / elapsed if elapsed else 0.0,
+        'p50_ms': percentile(send_latencies, 0.5) * 1000,
+        'p99_ms': percentile(send_latencies, 0.99) * 1000,
+        'peak_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,  # kilobytes on Linux
+        'finished': finished,
+    } | check_delivery(main, base_url, session, content, after_job, notices)
+
+
+def scenario_problems(result:dict) -> list:
+    problems = []
+    if not result['finished']:
+        problems.append(f"did not finish within {result['seconds']:.0f}s")
+    if result['duplicates']:
+        problems.append(f"{result['duplicates']} messages accepted more than once")
+    if result['short']:
+        problems.append(f"{result['short']} groups checkpointed as sent are missing messages")
+    if result['unreported']:
+        problems.append(f"{result['unreported']} groups neither sent nor reported to the operator")
+    if result['status'] == 'failed':
+        problems.append("job ended as 'failed'")
+    return problems
+
+
+def main_cli(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    fake_api.add_arguments(parser)
+    parser.add_argument('--files', type=int, default=5, help='files per group in the multi-file scenario')
+    parser.add_argument('--send-rate', type=float, default=1000, help='initial and maximum send rate given to main.py')
+    parser.add_argument('--fanout', type=int, default=50, help='groups sent to concurrently')
+    parser.add_argument('--instances', type=int, default=1, help='UltraMsg instances the broadcast is sharded across')
+    parser.add_argument('--scenario', choices=SCENARIOS, action='append', help='scenario to run, repeatable (default: all)')
+    parser.add_argument('--timeout', type=float, default=300, help='seconds a scenario may take before it counts as hung')
+    parser.add_argument('--check', action='store_true', help='exit with status 1 if a scenario hangs, resends, checkpoints undelivered groups, loses groups silently or fails')
+    args = parser.parse_args(argv)
+
+    process, base_url = start_fake_api(fake_api.options_from_args(args))
+    main, import_seconds = import_main(base_url, args)
+    main.logging.getLogger().setLevel(main.logging.WARNING)
+    ready_seconds = wait_ready(main)
+
+    latencies = []
+    record_request = main.record_request
+
+    def capture(url, elapsed, response=None, error=None):
+        failed = error is not None or response.status_code >= 400
+        latencies.append((main.endpoint_label(url), elapsed, failed))
+        record_request(url, elapsed, response, error)
+
+    main.record_request = capture
+
+    notices = []
+    send_txt_message_async = main.send_txt_message_async
+
+    async def capture_notice(chat_id, text):
+        notices.append(str(text))
+        return await send_txt_message_async(chat_id, text)
+
+    main.send_txt_message_async = capture_notice
+
+    print(f'import main: {import_seconds * 1000:.0f} ms, ready after warm-up: {ready_seconds * 1000:.0f} ms')
+    print(f"{'scenario':<12} {'requests':>9} {'errors':>7} {'seconds':>8} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'peak MB':>8} {'dupes':>6} {'short':>6} {'unrep':>6} {'job':>10}")
+    failures = []
+    for name in args.scenario or SCENARIOS:
+        result = run_scenario(main, name, base_url, args, latencies, notices)
+        print(f"{result['scenario']:<12} {result['requests']:>9} {result['errors']:>7} {result['seconds']:>8.2f} {result['per_second']:>8.1f} "
+              f"{result['p50_ms']:>8.1f} {result['p99_ms']:>8.1f} {result['peak_mb']:>8.1f} {result['duplicates']:>6} {result['short']:>6} {result['unreported']:>6} {result['status'] or '-':>10}")
+        failures += [f'{name}: {problem}' for problem in scenario_problems(result)]
+        if not result['finished']:
+            break  # the hung broadcast still holds the session, later scenarios would only measure it
+    print(f'fake api counters: {fake_api_stats(base_url)}')
+    process.terminate()
+    for failure in failures:
+        print(f'FAILED {failure}')
+    return 1 if args.check and failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main_cli())
@@ -0,0 +1,195 @@
+"""Local stand-in for the UltraMsg and Telegram APIs, used by benchmark.py.
+
+Run it on its own with `python fake_api.py --port 8100 --latency 0.05` and point
+main.py at it with ultramsg_api_base / telegram_api_base.
+"""
+from flask import Flask, request, jsonify
+from werkzeug.serving import WSGIRequestHandler, make_server
+import argparse
+import itertools
+import json
+import logging
+import random
+import threading
+import time
+
+
+class FakeState:
+    def __init__(self, latency:float, jitter:float, error_rate:float, rate_limit:float, groups:int, drain_rate:float):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.drain_rate = drain_rate
+        self.groups = [{'id': f'1203630{index:011d}@g.us', 'name': f'Group {index + 1}'} for index in range(groups)]
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.tokens = rate_limit
+        self.updated = time.monotonic()
+        self.counts = {'sent': 0, 'rejected': 0, 'throttled': 0, 'deleted': 0, 'telegram': 0, 'duplicates': 0}
+        self.messages = {}  # referenceId -> {(target, message): times accepted}
+        self.queue = 0.0
+        self.queue_at = time.monotonic()
+        self.connected = True
+
+    def delay(self):
+        time.sleep(max(0.0, random.gauss(self.latency, self.jitter)))
+
+    def allow(self) -> bool:
+        """Token bucket at rate_limit requests/second; 0 disables throttling."""
+        if not self.rate_limit:
+            return True
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate_limit, self.tokens + (now - self.updated) * self.rate_limit)
+            self.updated = now
+            if self.tokens < 1:
+                self.counts['throttled'] += 1
+                return False
+            self.tokens -= 1
+            return True
+
+    def enqueue(self, targets:list, endpoint:str, payload:dict):
+        with self.lock:
+            self.drain()
+            self.queue += len(targets)
+            self.counts['sent'] += len(targets)
+            reference = payload.get('referenceId')
+            if reference:
+                # the same message accepted twice for one target within a broadcast is a resend
+                message = json.dumps({key: value for key, value in payload.items() if key not in ('to', 'token')} | {'endpoint': endpoint}, sort_keys=True)
+                accepted = self.messages.setdefault(reference, {})
+                for target in targets:
+                    key = (target, message)
+                    self.counts['duplicates'] += key in accepted
+                    accepted[key] = accepted.get(key, 0) + 1
+
+    def drain(self):
+        now = time.monotonic()
+        self.queue = max(0.0, self.queue - (now - self.queue_at) * self.drain_rate) if self.drain_rate else 0.0
+        self.queue_at = now
+
+
+def create_app(state:FakeState) -> Flask:
+    app = Flask(__name__)
+
+    @app.route('/<instance>/messages/<endpoint>', methods=['POST'])
+    def ultramsg_message(instance, endpoint):
+        state.delay()
+        payload = request.get_json(silent=True) or request.form
+        if not state.connected:
+            return jsonify({'error': 'instance not connected'})
+        if not state.allow():
+            return jsonify({'error': 'Too Many Requests'}), 429
+        if random.random() < state.error_rate:
+            with state.lock:
+                state.counts['rejected'] += 1
+            return jsonify({'error': 'internal error'}), 500
+        if endpoint == 'delete':
+            with state.lock:
+                state.counts['deleted'] += 1
+            return jsonify({'success': 'message deleted'})
+        if endpoint == 'clear':
+            with state.lock:
+                state.queue = 0.0
+            return jsonify({'success': 'messages cleared'})
+        targets = [target for target in str(payload.get('to', '')).split(',') if target]
+        state.enqueue(targets, endpoint, payload)
+        return jsonify({'sent': 'true', 'message': 'ok', 'id': next(state.ids)})
+
+    @app.route('/<instance>/messages/statistics', methods=['GET'])
+    def ultramsg_statistics(instance):
+        state.delay()
+        with state.lock:
+            state.drain()
+            stats = {'sent': state.counts['sent'], 'queue': int(state.queue), 'unsent': 0,
+                     'invalid': state.counts['rejected'], 'expired': 0}
+        return jsonify({'messages_statistics': stats})
+
+    @app.route('/<instance>/groups', methods=['GET'])
+    def ultramsg_groups(instance):
+        state.delay()
+        if not state.connected:
+            return jsonify({'error': 'instance not connected'})
+        return jsonify(state.groups)
+
+    @app.route('/bot<token>/<method>', methods=['POST'])
+    def telegram_method(token, method):
+        state.delay()
+        with state.lock:
+            state.counts['telegram'] += 1
+        return jsonify({'ok': True, 'result': {'message_id': next(state.ids)}})
+
+    @app.route('/bot<token>/getFile', methods=['GET'])
+    def telegram_get_file(token):
+        state.delay()
+        return jsonify({'ok': True, 'result': {'file_id': request.args.get('file_id'), 'file_path': f"documents/{request.args.get('file_id')}.pdf"}})
+
+    @app.route('/file/bot<token>/<path:file_path>', methods=['GET'])
+    def telegram_file(token, file_path):
+        state.delay()
+        return b'%PDF-1.4\n' + b'0' * 1024 * 1024, 200, {'Content-Type': 'application/pdf'}
+
+    @app.route('/_connected', methods=['POST'])
+    def fake_connected():
+        """Simulate the phone behind the instance going offline and coming back."""
+        state.connected = bool((request.get_json(silent=True) or {}).get('connected', True))
+        return jsonify({'connected': state.connected})
+
+    @app.route('/_delivered', methods=['GET'])
+    def fake_delivered():
+        """Distinct messages each target got under one referenceId, and how many were accepted more than once."""
+        targets = {}
+        duplicates = 0
+        with state.lock:
+            for (target, _), times in state.messages.get(request.args.get('reference'), {}).items():
+                targets[target] = targets.get(target, 0) + 1
+                duplicates += times - 1
+        return jsonify({'targets': targets, 'duplicates': duplicates})
+
+    @app.route('/_stats', methods=['GET'])
+    def fake_stats():
+        with state.lock:
+            return jsonify(dict(state.counts))
+
+    return app
+
+
+class KeepAliveHandler(WSGIRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+
+def serve(port:int=0, **options):
+    """Start the fake API in a background thread and return (server, base_url, state)."""
+    state = FakeState(**options)
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = make_server('127.0.0.1', port, create_app(state), threaded=True, request_handler=KeepAliveHandler)
+    threading.Thread(target=server.serve_forever, name='fake-api', daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_port}', state
+
+
+def add_arguments(parser:argparse.ArgumentParser):
+    parser.add_argument('--latency', type=float, default=0.05, help='mean response latency in seconds')
+    parser.add_argument('--jitter', type=float, default=0.01, help='latency standard deviation in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of sends answered with HTTP 500')
+    parser.add_argument('--rate-limit', type=float, default=0.0, help='sends per second before HTTP 429, 0 for unlimited')
+    parser.add_argument('--groups', type=int, default=1000, help='number of groups returned by /groups')
+    parser.add_argument('--drain-rate', type=float, default=0.0, help='messages per second leaving the reported queue, 0 for an always empty queue')
+
+
+def options_from_args(args) -> dict:
+    return {'latency': args.latency, 'jitter': args.jitter, 'error_rate': args.error_rate,
+            'rate_limit': args.rate_limit, 'groups': args.groups, 'drain_rate': args.drain_rate}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--port', type=int, default=8100)
+    add_arguments(parser)
+    args = parser.parse_args()
+    server, base_url, _ = serve(args.port, **options_from_args(args))
+    print(f'Fake UltraMsg/Telegram API listening on {base_url}')
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -1,30 +1,43 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, abort, send_from_directory
 import requests
 import os
-import firebase_admin
 from dotenv import load_dotenv
-from firebase_admin import credentials, firestore
-from firebase_admin.firestore import firestore as fs
 import json
 import time
+import asyncio
+import httpx
 import logging
-from functools import lru_cache
+import hashlib
+import hmac
+import re
+import sqlite3
+import tempfile
+from urllib.parse import urlsplit
+import threading
+import heapq
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+from collections import OrderedDict, deque
+from bisect import bisect_left
+from functools import wraps
 from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 load_dotenv()
 executor = ThreadPoolExecutor(max_workers=8)
+broadcast_lock = threading.Lock()
 
 wappsender = os.getenv('wappsender')
 bot_token = os.getenv('bot_token')
-telegram_api_url = f"https://api.telegram.org/bot{bot_token}"
+telegram_api_base = os.getenv('telegram_api_base', 'https://api.telegram.org')
+telegram_api_url = f"{telegram_api_base}/bot{bot_token}"
 instance = os.getenv('instance')
+ultramsg_api_base = os.getenv('ultramsg_api_base', 'https://api.ultramsg.com')
 wapp_token = os.getenv('wapp_token')
 
-cred = credentials.Certificate('wappsender-key.json')
-firebase_admin.initialize_app(cred)
-db = firestore.client()
-
 logging.basicConfig(level=logging.INFO)
+logging.getLogger('httpx').setLevel(logging.WARNING)
 
 app = Flask(__name__)
 
@@ -32,220 +45,1376 @@ class WappSenderError(Exception):
     pass
 
 login_op={
-    'login_mode':False,
     'login_users':{
         1083765153: True,
     }
 }
 
-exclude_op={
-    'exclude_mode':False
+class Session:
+    """Conversation and broadcast state of one Telegram chat."""
+    __slots__ = ('chat_id', 'lock', 'login_mode', 'exclude_mode', 'group_ids', 'upload_content_mode', 'content',
+                 'broadcast_mode', 'main_loop_mood', 'group_count', 'groups_len', 'terminate', 'started_at', 'finished_at')
+    persisted = ('login_mode', 'exclude_mode', 'group_ids', 'upload_content_mode', 'content', 'broadcast_mode')
+
+    def __init__(self, chat_id:int):
+        self.chat_id = chat_id
+        self.lock = threading.RLock()
+        self.login_mode = False
+        self.exclude_mode = False
+        self.group_ids = []
+        self.upload_content_mode = False
+        self.content = {'files':[]}
+        self.broadcast_mode = False
+        self.main_loop_mood = False
+        self.group_count = 0
+        self.groups_len = 0
+        self.terminate = False
+        self.started_at = 0
+        self.finished_at = 0
+
+session_op={
+    'backend':os.getenv('session_backend', 'memory'),
+    'sessions':{},
+}
+sessions_lock = threading.Lock()
+
+index_op={
+    'page_size':int(os.getenv('exclude_page_size', 20)),
+    'groups':None,
+    'index':None,
 }
+index_lock = threading.Lock()
 
-upload_content_op={
-    'upload_content_mode':False,
-    'content':{
-        'files':[]
-    }
+bot_commands_list=['/start','/login','/upload_content','/clear_content','/broadcast','/exclude_users','/show_status','/terminate','/schedules']
+
+http_op={
+    'pool_size':int(os.getenv('http_pool_size', 32)),
+    'retries':int(os.getenv('http_retries', 3)),
+    'backoff':float(os.getenv('http_backoff', 0.5)),
+    'timeout':float(os.getenv('http_timeout', 10)),
+    'requests':0,
+    'errors':0,
+    'latency_buckets':[0.1, 0.25, 0.5, 1, 2.5, 5, 10],
+    'latency_counts':[0]*8,
+}
+http_lock=threading.Lock()
+
+metrics_op={
+    'endpoints':{},
+    'errors':{},
+    'broadcasts':0,
+    'broadcast_seconds':0.0,
+    'broadcast_groups':0,
+    'last_broadcast_seconds':0.0,
+    'last_groups_per_second':0.0,
+}
+
+async_op={
+    'fanout':int(os.getenv('fanout_workers', 50)),
+    'client':None,
+    'limits':{
+        'ultramsg':asyncio.Semaphore(int(os.getenv('ultramsg_concurrency', 200))),
+        'telegram':asyncio.Semaphore(int(os.getenv('telegram_concurrency', 20))),
+    },
+}
+batch_op={
+    'size':int(os.getenv('batch_size', 50)),
+    'retries':int(os.getenv('batch_retries', 2)),
+    'split':int(os.getenv('batch_split', 5)),
+    'spread_interval':float(os.getenv('batch_spread_interval', 10)),
+}
+cache_op={
+    'groups_ttl':float(os.getenv('groups_cache_ttl', 600)),
+    'exclusions_ttl':float(os.getenv('exclusions_cache_ttl', 300)),
+    'refresh_ahead':float(os.getenv('cache_refresh_ahead', 0.8)),
+    'caches':{},
+}
+media_op={
+    'relay_url':os.getenv('media_relay_url', '').rstrip('/'),
+    'cache_dir':os.getenv('media_cache_dir', 'media_cache'),
+    'chunk_size':64 * 1024,
+    'files':{},
+    # relayed files unused for max_age are removed, then the oldest until the cache fits in max_mb
+    'max_age':float(os.getenv('media_cache_max_age_hours', 48)) * 3600,
+    'max_mb':float(os.getenv('media_cache_max_mb', 2048)),
+    # per media type limits of the UltraMsg send endpoints
+    'limits':{
+        'photos':{'max_mb':float(os.getenv('media_max_mb_photos', 16)), 'mime':('image/jpeg', 'image/png', 'image/gif', 'image/webp')},
+        'videos':{'max_mb':float(os.getenv('media_max_mb_videos', 16)), 'mime':('video/mp4', 'video/3gpp', 'video/quicktime')},
+        'documents':{'max_mb':float(os.getenv('media_max_mb_documents', 30)), 'mime':None},
+    },
+    'telegram_max_mb':float(os.getenv('telegram_download_max_mb', 20)),  # largest file the Bot API lets us download
+    'timeout':float(os.getenv('media_timeout', 10)),
+    'retries':int(os.getenv('media_retries', 2)),
+    'preflight_ttl':float(os.getenv('media_preflight_ttl', 3000)),  # Telegram file links stay valid for at least an hour
+    'preflight':{},
+}
+media_lock = threading.Lock()
+
+firestore_op={
+    'key_file':os.getenv('firebase_key_file', 'wappsender-key.json'),
+    'client':None,  # built by get_db() on first use
+    'flush_size':int(os.getenv('firestore_flush_size', 200)),
+    'flush_interval':float(os.getenv('firestore_flush_interval', 10)),
+    'chunk_size':500,
+    'flushed_at':0,
+    'buffers':{},
+}
+firestore_lock = threading.Lock()
+firestore_flush_lock = threading.Lock()
+firestore_init_lock = threading.Lock()
+
+warmup_op={
+    'enabled':os.getenv('warm_up', '1') == '1',
+    'groups':os.getenv('warm_up_groups', '1') == '1',
+    'started_at':time.monotonic(),
+    'running':False,
+    'ready':False,
+    'ready_seconds':None,
+    'errors':{},
+}
+warmup_lock = threading.Lock()
+
+terminate_op={
+    'drain_timeout':float(os.getenv('terminate_drain_timeout', 30)),
+    'poll_interval':float(os.getenv('terminate_poll_interval', 1)),
+    'progress_step':0.1,
+}
+update_op={
+    'workers':int(os.getenv('update_workers', 4)),
+    'dedup_size':int(os.getenv('update_dedup_size', 4096)),
+    'seen':OrderedDict(),
+    'queues':{},
+    'received':0,
+    'duplicates':0,
+    'processed':0,
+    'failed':0,
+    'wait_seconds':0.0,
+    'duration_seconds':0.0,
+    'latency_counts':[0] * 8,
+}
+update_lock = threading.Lock()
+update_executor = ThreadPoolExecutor(max_workers=update_op['workers'], thread_name_prefix='updates')
+
+async_loop = asyncio.new_event_loop()
+threading.Thread(target=async_loop.run_forever, name='async-sender', daemon=True).start()
+
+pacing_op={
+    'rate':float(os.getenv('send_rate', 10)),
+    'max_rate':float(os.getenv('send_rate_max', 40)),
+    'min_rate':float(os.getenv('send_rate_min', 0.5)),
+    'burst':float(os.getenv('send_burst', 10)),
+    'increase':float(os.getenv('send_rate_increase', 0.1)),
+    'decrease':float(os.getenv('send_rate_decrease', 0.5)),
+    # in-flight sends all see the same overload, count their 429s/5xx as one signal per interval
+    'decrease_interval':float(os.getenv('send_rate_decrease_interval', 2)),
+    'throttle_retries':int(os.getenv('send_throttle_retries', 5)),
+    'queue_low':int(os.getenv('send_queue_low', 20)),
+    'queue_high':int(os.getenv('send_queue_high', 200)),
+    'check_interval':float(os.getenv('send_queue_check_interval', 15)),
+}
+
+instance_op={
+    # comma separated instance_id:token pairs, falls back to the single instance/wapp_token pair
+    'configured':os.getenv('instances', ''),
+    'disconnected':('not connected', 'not authorized', 'disconnected'),
+}
+
+circuit_op={
+    'failures':int(os.getenv('circuit_failures', 5)),
+    'cooldown':float(os.getenv('circuit_cooldown', 30)),
+    'probe_interval':float(os.getenv('circuit_probe_interval', 15)),
+}
+
+job_op={
+    'checkpoint_size':int(os.getenv('checkpoint_size', 10)),
+    'checkpoint_interval':float(os.getenv('checkpoint_interval', 2)),
+    'checkpointed_at':0,
+    'served':[],
+}
+schedule_op={
+    'timezone':ZoneInfo(os.getenv('schedule_timezone', 'UTC')),
+    'busy_retry':float(os.getenv('schedule_busy_retry', 60)),
+    'heap':[],
 }
+schedule_cond = threading.Condition()
 
-broadcast_op={
-    'broadcast_mode':False,
-    'main_loop_mood':False,
-    'group_count':0,
-    'groups_len':0,
-    'terminate':False,
+delivery_op={
+    # with the UltraMsg message webhook pointed at /ultramsg?token=<delivery_webhook_token>, terminate deletes the WhatsApp ids it reports
+    'enabled':os.getenv('delivery_webhook', '0') == '1',
+    'token':os.getenv('delivery_webhook_token', ''),
+    'retention':float(os.getenv('delivery_retention_days', 7)) * 86400,
+    'ranks':{'created':0, 'pending':0, 'server':1, 'device':2, 'read':3, 'played':4, 'error':5, 'failed':5},
 }
 
-bot_commands_list=['/start','/login','/upload_content','/clear_content','/broadcast','/exclude_users','/show_status','/terminate']
+jobs_db = sqlite3.connect(os.getenv('jobs_db', 'wappsender.db'), check_same_thread=False)
+jobs_lock = threading.Lock()
 
 # -----------------------------------------------------------
 
-def send_text(target:str,text:str):
+def build_session():
+    """Create a keep-alive session with one connection pool per host."""
+    retry = Retry(
+        total=http_op['retries'],
+        connect=http_op['retries'],
+        read=http_op['retries'],
+        status=http_op['retries'],
+        backoff_factor=http_op['backoff'],
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=frozenset({'GET'}),  # sends are not idempotent, only retry them on connect errors
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=http_op['pool_size'], max_retries=retry)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+http_session = build_session()
+
+def endpoint_label(url:str) -> str:
+    path = urlsplit(url).path
+    if path.startswith('/file/bot'):
+        return 'telegram:file'
+    if path.startswith('/bot'):
+        return 'telegram:' + path.rsplit('/', 1)[-1]
+    return 'ultramsg:' + path.split('/', 2)[-1]  # drop the instance id
+
+def record_request(url:str, elapsed:float, response=None, error=None):
+    endpoint = endpoint_label(url)
+    if error is not None:
+        error_type = type(error).__name__
+    elif response.status_code >= 400:
+        error_type = f'http_{response.status_code}'
+    else:
+        error_type = None
+    sent = int(response.request.headers.get('Content-Length') or 0) if response is not None else 0
+    bucket = bisect_left(http_op['latency_buckets'], elapsed)
+    with http_lock:
+        http_op['requests'] += 1
+        http_op['errors'] += error is not None
+        http_op['latency_counts'][bucket] += 1
+        stats = metrics_op['endpoints'].get(endpoint)
+        if stats is None:
+            stats = metrics_op['endpoints'][endpoint] = {'count':0, 'sum':0.0, 'bytes':0, 'latency_counts':[0] * len(http_op['latency_counts'])}
+        stats['count'] += 1
+        stats['sum'] += elapsed
+        stats['bytes'] += sent
+        stats['latency_counts'][bucket] += 1
+        if error_type is not None:
+            metrics_op['errors'][(endpoint, error_type)] = metrics_op['errors'].get((endpoint, error_type), 0) + 1
+
+def http_request(method:str, url:str, timeout=None, **kwargs):
+    start = time.perf_counter()
+    response = error = None
     try:
-        url = f"https://api.ultramsg.com/{instance}/messages/chat"
-        payload = json.dumps({
-            "to": target,
-            "token": wapp_token,
-            "body": text
-        })
-        response = requests.request("POST", url, headers={'Content-Type': 'application/json'}, data=payload, timeout=10)
-        logging.info(response.text)
+        response = http_session.request(method, url, timeout=timeout or http_op['timeout'], **kwargs)
+        return response
     except Exception as e:
-        raise WappSenderError(f'{e} - in send_text()')
+        error = e
+        raise
+    finally:
+        record_request(url, time.perf_counter() - start, response, error)
+
+def run_async(coro):
+    """Run a coroutine on the sender loop and wait for its result from a regular thread."""
+    return asyncio.run_coroutine_threadsafe(coro, async_loop).result()
+
+def get_async_client():
+    if async_op['client'] is None:
+        transport = httpx.AsyncHTTPTransport(
+            retries=http_op['retries'],  # connect errors only, like the sync session for POSTs
+            limits=httpx.Limits(max_connections=None, max_keepalive_connections=http_op['pool_size']),
+        )
+        async_op['client'] = httpx.AsyncClient(transport=transport, timeout=http_op['timeout'])
+    return async_op['client']
+
+async def async_request(provider:str, method:str, url:str, **kwargs):
+    async with async_op['limits'][provider]:
+        start = time.perf_counter()
+        response = error = None
+        try:
+            response = await get_async_client().request(method, url, **kwargs)
+            return response
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            record_request(url, time.perf_counter() - start, response, error)
+
+def get_pool_counts():
+    connections = 0
+    pool_requests = 0
+    for adapter in set(http_session.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                connections += pool.num_connections
+                pool_requests += pool.num_requests
+    return connections, pool_requests
 
-def send_image(target:str,cap:str,link:str):
+def get_http_stats():
+    connections, pool_requests = get_pool_counts()
+    with http_lock:
+        labels = [str(bucket) for bucket in http_op['latency_buckets']] + ['+Inf']
+        return {
+            'requests': http_op['requests'],
+            'errors': http_op['errors'],
+            'connections_opened': connections,
+            'reuse_ratio': round(1 - connections / pool_requests, 3) if pool_requests else 0.0,
+            'latency_seconds': dict(zip(labels, http_op['latency_counts'])),
+        }
+
+def ttl_cache(ttl:float):
+    """Cache a no-argument loader for ttl seconds, reloading it in the background once it is refresh_ahead stale."""
+    def decorator(loader):
+        state = {'value':None, 'loaded_at':None, 'generation':0, 'refreshing':False, 'hits':0, 'misses':0, 'refreshes':0, 'errors':0}
+        lock = threading.Lock()
+
+        def store(value, generation):
+            with lock:
+                if generation == state['generation']:  # skip loads that raced with cache_clear()
+                    state['value'] = value
+                    state['loaded_at'] = time.monotonic()
+
+        def refresh():
+            try:
+                generation = state['generation']
+                store(loader(), generation)
+                state['refreshes'] += 1
+            except Exception as e:
+                state['errors'] += 1
+                logging.warning(f'{e} - while refreshing {loader.__name__}()')
+            finally:
+                state['refreshing'] = False
+
+        @wraps(loader)
+        def wrapper():
+            with lock:
+                if state['loaded_at'] is not None:
+                    age = time.monotonic() - state['loaded_at']
+                    if age < ttl:
+                        state['hits'] += 1
+                        if age >= ttl * cache_op['refresh_ahead'] and not state['refreshing']:
+                            state['refreshing'] = True
+                            executor.submit(refresh)
+                        return state['value']
+                state['misses'] += 1
+                generation = state['generation']
+            value = loader()
+            store(value, generation)
+            return value
+
+        def cache_clear():
+            with lock:
+                state['value'] = None
+                state['loaded_at'] = None
+                state['generation'] += 1
+
+        def cache_stats():
+            age = time.monotonic() - state['loaded_at'] if state['loaded_at'] is not None else None
+            return {key: state[key] for key in ('hits', 'misses', 'refreshes', 'errors')} | {'age': age, 'ttl': ttl}
+
+        wrapper.cache_clear = cache_clear
+        wrapper.cache_stats = cache_stats
+        cache_op['caches'][loader.__name__] = wrapper
+        return wrapper
+    return decorator
+
+# -----------------------------------------------------------
+
+class TokenBucket:
+    """Thread-safe token bucket whose refill rate can be changed while in use."""
+
+    def __init__(self, rate:float, burst:float, max_rate:float):
+        self.rate = rate
+        self.max_rate = max_rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.decreased_at = 0
+        self.lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """Take one token and return how long the caller must wait before using it."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def acquire(self):
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+    def set_rate(self, rate:float):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.rate = max(pacing_op['min_rate'], min(rate, self.max_rate))
+
+    def decrease(self, factor:float):
+        """Multiply the rate by factor, at most once per decrease_interval."""
+        with self.lock:
+            now = time.monotonic()
+            if now - self.decreased_at < pacing_op['decrease_interval']:
+                return
+            self.decreased_at = now
+        self.set_rate(self.rate * factor)
+
+def build_bucket(name:str):
+    rate = float(os.getenv(f'send_rate_{name}', pacing_op['rate']))
+    max_rate = float(os.getenv(f'send_rate_max_{name}', pacing_op['max_rate']))
+    return TokenBucket(rate, pacing_op['burst'], max_rate)
+
+class InstanceUnavailable(WappSenderError):
+    """A send failed because of the instance (timeout, 5xx), not because of its recipient."""
+
+class InstanceDisconnected(InstanceUnavailable):
+    """An UltraMsg instance lost its WhatsApp connection or could not be reached, so nothing was sent."""
+
+class CircuitOpen(InstanceDisconnected):
+    """The instance's circuit breaker is open and the send was refused without trying."""
+
+class BroadcastIncomplete(WappSenderError):
+    """A broadcast ended with targets that did not get all of it, they have already been reported to the operator."""
+
+class CircuitBreaker:
+    """Open after circuit_failures consecutive failures, then refuse requests until a probe succeeds or circuit_cooldown lets one trial through."""
+    __slots__ = ('state', 'failures', 'opened_at', 'lock')
+
+    def __init__(self):
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0
+        self.lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self.lock:
+            if self.state == 'closed':
+                return True
+            if self.state == 'open' and time.monotonic() - self.opened_at >= circuit_op['cooldown']:
+                self.state = 'half_open'  # let a single trial request through
+                return True
+            return False
+
+    def success(self):
+        with self.lock:
+            self.state = 'closed'
+            self.failures = 0
+
+    def failure(self) -> bool:
+        """Count a failure, returning True if it opened the circuit."""
+        with self.lock:
+            self.failures += 1
+            if self.state == 'half_open' or self.state == 'closed' and self.failures >= circuit_op['failures']:
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+class Instance:
+    """One UltraMsg instance of the pool, with its own send buckets, queue depth and circuit breaker."""
+    __slots__ = ('id', 'token', 'api_url', 'buckets', 'queue', 'hold', 'checked_at', 'check_lock', 'connected', 'groups', 'breaker')
+
+    def __init__(self, id:str, token:str):
+        self.id = id
+        self.token = token
+        self.api_url = f"{ultramsg_api_base}/{id}"
+        self.buckets = {name: build_bucket(name) for name in ('global', 'chat', 'image', 'video', 'document', 'delete')}
+        self.queue = 0
+        self.hold = False
+        self.checked_at = 0
+        self.check_lock = threading.Lock()
+        self.connected = True
+        self.groups = frozenset()
+        self.breaker = CircuitBreaker()
+
+    def available(self) -> bool:
+        return self.connected and self.breaker.state == 'closed'
+
+    def record_failure(self, reason):
+        if self.breaker.failure():
+            logging.warning(f'instance {self.id} circuit opened after {self.breaker.failures} failures: {reason}')
+
+def load_instances():
+    pairs = [item.split(':', 1) for item in instance_op['configured'].split(',') if item.strip()]
+    if not pairs:
+        pairs = [(instance or '', wapp_token or '')]  # unconfigured: importable, sends fail at the provider
+    return [Instance(id.strip(), token.strip()) for id, token in pairs]
+
+instance_pool = load_instances()
+instance_by_id = {inst.id: inst for inst in instance_pool}
+
+def primary_instance():
+    return next((inst for inst in instance_pool if inst.available()), instance_pool[0])
+
+def candidate_instances(target:str):
+    """Available instances that are members of the target group, or every available instance for targets no listing knows."""
+    available = [inst for inst in instance_pool if inst.available()]
+    return [inst for inst in available if target in inst.groups] or available
+
+def any_instance_available() -> bool:
+    return any(inst.available() for inst in instance_pool)
+
+def shard_targets(ids:list, cost:int=1):
+    """Assign every target to one of its candidate instances, least queued first, counting `cost` messages per target."""
+    if len(instance_pool) == 1:
+        return {id: instance_pool[0] for id in ids}
+    for inst in instance_pool:
+        check_queue_depth(inst)
+    load = {inst.id: inst.queue for inst in instance_pool}
+    assignment = {}
+    for id in ids:
+        inst = min(candidate_instances(id) or instance_pool, key=lambda inst: load[inst.id])
+        load[inst.id] += cost
+        assignment[id] = inst
+    return assignment
+
+def failover(target:str, failed:Instance):
+    """Return another connected instance for the target, or None if there is none."""
+    candidates = [inst for inst in candidate_instances(target) if inst is not failed]
+    return min(candidates, key=lambda inst: inst.queue) if candidates else None
+
+def mark_disconnected(inst:Instance, reason):
+    if inst.connected:
+        logging.warning(f'instance {inst.id} disconnected: {reason}')
+    inst.connected = False
+
+def is_disconnected(response) -> bool:
     try:
-        url = f"https://api.ultramsg.com/{instance}/messages/image"
-        payload = json.dumps({
-            "to": target,
-            "image": link,
-            "token": wapp_token,
-            "caption": cap,
-        })
-        response = requests.request("POST", url, headers={'Content-Type': 'application/json'}, data=payload, timeout=10)
-        logging.info(response.text)
-    except Exception as e:
-        raise WappSenderError(f'{e} - in send_image()')
+        error = response.json().get('error')
+    except (ValueError, AttributeError):
+        return False
+    return bool(error) and any(marker in str(error).lower() for marker in instance_op['disconnected'])
+
+def message_ref(inst:Instance, message_id:str) -> str:
+    return f'{inst.id}:{message_id}'
+
+def parse_message_ref(ref:str):
+    """Split a stored message id into its instance and UltraMsg id; ids stored before the pool default to the primary instance."""
+    instance_id, _, message_id = str(ref).rpartition(':')
+    return instance_by_id.get(instance_id, instance_pool[0]), message_id
 
-def send_video(target:str,cap:str,link:str):
+def pace(inst:Instance, endpoint:str):
+    """Block until both the global and the endpoint bucket of the instance allow another send."""
+    check_queue_depth(inst)
+    inst.buckets['global'].acquire()
+    inst.buckets[endpoint].acquire()
+
+def report_pace(inst:Instance, endpoint:str, status_code:int):
+    """Halve the rate on 429/5xx (once per decrease_interval), otherwise creep back up unless the queue is backed up."""
+    for bucket in (inst.buckets['global'], inst.buckets[endpoint]):
+        if status_code == 429 or status_code >= 500:
+            bucket.decrease(pacing_op['decrease'])
+        elif not inst.hold:
+            bucket.set_rate(bucket.rate + pacing_op['increase'])
+
+def check_queue_depth(inst:Instance):
+    now = time.monotonic()
+    if now - inst.checked_at < pacing_op['check_interval'] or not inst.check_lock.acquire(blocking=False):
+        return
     try:
-        url = f"https://api.ultramsg.com/{instance}/messages/video"
-        payload = json.dumps({
-            "to": target,
-            "token": wapp_token,
-            "video": link,
-            "caption": cap,
-        })
-        response = requests.request("POST", url, headers={'Content-Type': 'application/json'}, data=payload, timeout=10)
-        logging.info(response.text)
+        inst.checked_at = now
+        queue = int(fetch_statistics(inst)['queue'])
+        inst.queue = queue
+        inst.hold = queue > pacing_op['queue_low']
+        if queue >= pacing_op['queue_high']:
+            inst.buckets['global'].decrease(pacing_op['decrease'])
     except Exception as e:
-        raise WappSenderError(f'{e} - in send_video()')
+        logging.warning(f'{e} - in check_queue_depth({inst.id})')
+    finally:
+        inst.check_lock.release()
+
+def throttle_delay(response, attempt:int) -> float:
+    """Seconds to wait before repeating a send answered with 429, the provider's Retry-After if it gave one."""
+    try:
+        return float(response.headers['Retry-After'])
+    except (KeyError, ValueError):
+        return http_op['backoff'] * 2 ** attempt
 
-def send_document(target:str,cap:str,link:str,docname:str):
+def ultramsg_send(endpoint:str, payload:dict, inst:Instance=None):
+    inst = inst or primary_instance()
+    if not inst.breaker.allow():
+        raise CircuitOpen(f'instance {inst.id} circuit is open')
+    url = f"{inst.api_url}/messages/{endpoint}"
+    for attempt in range(pacing_op['throttle_retries'] + 1):
+        if attempt:
+            # a 429 means nothing was accepted, so the same send can go again
+            time.sleep(throttle_delay(response, attempt))
+        pace(inst, endpoint)
+        try:
+            response = http_request("POST", url, headers={'Content-Type': 'application/json'}, data=json.dumps({**payload, "token": inst.token}))
+        except Exception as e:
+            inst.record_failure(e)
+            raise
+        if response.status_code >= 500 or is_disconnected(response):
+            inst.record_failure(response.text)
+        else:
+            inst.breaker.success()
+        report_pace(inst, endpoint, response.status_code)
+        logging.debug(response.text)
+        if response.status_code != 429:
+            return response
+    raise WappSenderError(f'instance {inst.id} still answers 429 after {attempt + 1} attempts - in ultramsg_send({endpoint})')
+
+def send_text(target:str,text:str):
     try:
-        url = f"https://api.ultramsg.com/{instance}/messages/document"
-        payload = json.dumps({
-            "token": wapp_token,
+        ultramsg_send('chat', {
             "to": target,
-            "filename": docname,
-            "document": link,
-            "caption": cap,
+            "body": text
         })
-        response = requests.request("POST", url, headers={'Content-Type': 'application/json'}, data=payload, timeout=10)
-        logging.info(response.text)
     except Exception as e:
-        raise WappSenderError(f'{e} - in send_document()')
-    
-def broadcast(ids:list,content:dict,user_id:str):
+        raise WappSenderError(f'{e} - in send_text()')
+
+def file_payload(target:str,cap:str,file:dict):
+    (file_type, file_content),= file.items()
+    if file_type=='videos':
+        return 'video', {"to": target, "video": file_content, "caption": cap}
+    elif file_type=='photos':
+        return 'image', {"to": target, "image": file_content, "caption": cap}
+    elif file_type=='documents':
+        (doc_name, doc_link),=file_content.items()
+        return 'document', {"to": target, "filename": doc_name, "document": doc_link, "caption": cap}
+    raise WappSenderError(f'{file_type} is not a supported file type')
+
+async def pace_async(inst:Instance, endpoint:str):
+    if time.monotonic() - inst.checked_at >= pacing_op['check_interval'] and not inst.check_lock.locked():
+        await asyncio.to_thread(check_queue_depth, inst)
+    for name in ('global', endpoint):
+        delay = inst.buckets[name].reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+async def ultramsg_send_async(endpoint:str, payload:dict, inst:Instance):
+    if not inst.breaker.allow():
+        raise CircuitOpen(f'instance {inst.id} circuit is open - in ultramsg_send_async({endpoint})')
+    url = f"{inst.api_url}/messages/{endpoint}"
+    for attempt in range(pacing_op['throttle_retries'] + 1):
+        if attempt:
+            # a 429 means nothing was accepted, so the same send can go again
+            await asyncio.sleep(throttle_delay(response, attempt))
+        await pace_async(inst, endpoint)
+        try:
+            response = await async_request('ultramsg', "POST", url, json={**payload, "token": inst.token})
+        except httpx.ConnectError as e:
+            # nothing reached the instance, so the send can safely go through another one
+            mark_disconnected(inst, e)
+            inst.record_failure(e)
+            raise InstanceDisconnected(f'{type(e).__name__}: {e} - in ultramsg_send_async({endpoint})')
+        except httpx.TransportError as e:
+            inst.record_failure(e)
+            raise InstanceUnavailable(f'{type(e).__name__}: {e} - in ultramsg_send_async({endpoint})')
+        except Exception as e:
+            raise WappSenderError(f'{type(e).__name__}: {e} - in ultramsg_send_async({endpoint})')
+        report_pace(inst, endpoint, response.status_code)
+        logging.debug(response.text)
+        if response.status_code != 429:
+            break
+    else:
+        raise WappSenderError(f'instance {inst.id} still answers 429 after {attempt + 1} attempts - in ultramsg_send_async({endpoint})')
+    if is_disconnected(response):
+        mark_disconnected(inst, response.text)
+        inst.record_failure(response.text)
+        raise InstanceDisconnected(f'instance {inst.id} is not connected - in ultramsg_send_async({endpoint})')
+    if response.status_code >= 500:
+        inst.record_failure(f'HTTP {response.status_code}')
+        raise InstanceUnavailable(f'instance {inst.id} answered {response.status_code} - in ultramsg_send_async({endpoint})')
+    inst.breaker.success()
+    return response
+
+def parse_send_response(response):
+    """Return the message ids of an accepted UltraMsg send, or None if it was rejected."""
+    try:
+        result = response.json()
+    except ValueError:
+        return None
+    if response.status_code >= 400:
+        return None
+    if isinstance(result, dict) and ('error' in result or str(result.get('sent')).lower() == 'false'):
+        return None
+    results = result if isinstance(result, list) else [result]
+    return [str(item['id']) for item in results if isinstance(item, dict) and 'id' in item]
+
+def group_steps(content:dict) -> int:
+    return len(content['files']) + ('text' in content and content['text']!=None)
+
+async def send_files_to_group(id:str,content:dict,session:Session,inst:Instance,progress:dict,job_id=None):
+    """Send every file and then the caption to one group, in order, moving to another member instance if this one drops.
+
+    progress[id] counts the steps the group has been sent, a group that was cut short carries on from there.
+    """
+    steps = [file_payload(id,'',file) for file in content['files']]
+    if 'text' in content and content['text']!=None:
+        steps.append(('chat', {"to": id, "body": content['text']}))
+    reference = delivery_reference(session.chat_id, job_id)
+    for step, (endpoint, payload) in enumerate(steps):
+        if step < progress.get(id, 0):
+            continue
+        payload["referenceId"] = reference
+        if session.terminate:
+            return False
+        while True:
+            try:
+                response = await ultramsg_send_async(endpoint, payload, inst)
+                break
+            except InstanceDisconnected:
+                inst = failover(id, inst)
+                if inst is None:
+                    raise
+        message_ids = parse_send_response(response)
+        if message_ids is None:
+            # not sent, leave the group pending instead of counting it
+            raise WappSenderError(f'UltraMsg rejected the {endpoint} message to {id}: {response.text[:200]} - in send_files_to_group()')
+        if not delivery_op['enabled']:
+            buffer_message_ids(session.chat_id, [message_ref(inst, message_id) for message_id in message_ids])
+        progress[id] = step + 1
+    with broadcast_lock:
+        session.group_count+=1
+    checkpoint(job_id,[id])
+    return True
+
+async def fan_out_async(ids:list,content:dict,session:Session,job_id=None,window:float=0,progress:dict=None,failed:dict=None):
+    stop = asyncio.Event()
+    limit = asyncio.Semaphore(async_op['fanout'])
+    assignment = await asyncio.to_thread(shard_targets, ids, group_steps(content))
+    progress = {} if progress is None else progress
+    failed = {} if failed is None else failed
+    started_at = time.monotonic()
+    sent = set()
+    error = None
+
+    async def run(index, id):
+        nonlocal error
+        if window:
+            # start the groups evenly spread over the window instead of all at once
+            try:
+                await asyncio.wait_for(stop.wait(), max(0.0, started_at + window * index / len(ids) - time.monotonic()))
+            except asyncio.TimeoutError:
+                pass
+        async with limit:
+            # after an outage or /terminate no new group starts, the ones already going finish their files and caption
+            if stop.is_set() or session.terminate:
+                return
+            try:
+                if await send_files_to_group(id,content,session,assignment[id],progress,job_id):
+                    sent.add(id)
+            except InstanceDisconnected as e:
+                # nothing of this step went out, the group stays unsent; only the breakers decide it is an outage
+                logging.warning(f'{e} - in fan_out()')
+                if not any_instance_available():
+                    error = error or e
+                    stop.set()
+            except InstanceUnavailable as e:
+                # the step may or may not have gone out, the group must not get it again
+                logging.warning(f'{e} - in fan_out()')
+                failed[id] = 'unknown'
+                set_target_status(job_id,[id],'unknown')
+            except WappSenderError as e:
+                logging.warning(f'{e} - in fan_out()')
+                failed[id] = 'rejected'
+                if progress.get(id):
+                    set_target_status(job_id,[id],'partial')
+
+    pending = {asyncio.ensure_future(run(index, id)) for index, id in enumerate(ids)}
+    while pending:
+        done, pending = await asyncio.wait(pending, timeout=0.5, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            if task.exception() is not None:
+                error = error or task.exception()
+                stop.set()
+        if session.terminate:
+            stop.set()
+    return [id for id in ids if id not in sent and id not in failed], error
+
+def fan_out(ids:list,content:dict,session:Session,job_id=None,window:float=0,progress:dict=None,failed:dict=None):
+    """Send to many groups concurrently, or spread over window seconds, returning the targets still to send and the outage that stopped it.
+
+    Steps each group got are counted in progress, so the caller can tell partly sent groups from untouched ones. A group whose
+    send was rejected, timed out or failed on the server goes into failed as 'rejected' or 'unknown' and is not sent again,
+    the other groups carry on.
+    """
+    return run_async(fan_out_async(ids,content,session,job_id,window,progress,failed))
+
+async def send_batch(batch:list,content:dict,inst:Instance,reference=None):
+    caption = content.get('text', '')
+    if content['files']:
+        endpoint, payload = file_payload(','.join(batch),caption,content['files'][0])
+    else:
+        endpoint, payload = 'chat', {"to": ','.join(batch), "body": caption}
+    if reference:
+        payload["referenceId"] = reference
+    try:
+        response = await ultramsg_send_async(endpoint,payload,inst)
+    except InstanceDisconnected as e:
+        # never reached the instance, safe to send again
+        logging.warning(f'{e} - in send_batch()')
+        return None
+    except InstanceUnavailable:
+        # a timeout or 5xx may still have gone out, the caller must not send it again
+        raise
+    except WappSenderError as e:
+        logging.warning(f'{e} - in send_batch()')
+        return None
+    result = parse_send_response(response)
+    return None if result is None else [message_ref(inst, message_id) for message_id in result]
+
+async def send_in_batches_async(ids:list,content:dict,window:float=0,session:Session=None,reference=None,job_id=None):
+    limit = asyncio.Semaphore(async_op['fanout'])
+    size = batch_op['size']
+    message_ids = []
+    unsend_targets = ids
+    unknown_targets = []
+
+    async def run(batch, inst, delay):
+        # wait for the batch's slot in short steps, /terminate must not sit out the rest of the window
+        deadline = time.monotonic() + delay
+        while time.monotonic() < deadline and not (session is not None and session.terminate):
+            await asyncio.sleep(min(0.5, deadline - time.monotonic()))
+        if session is not None and session.terminate:
+            return None
+        async with limit:
+            try:
+                result = await send_batch(batch,content,inst,reference)
+            except InstanceUnavailable as e:
+                # nobody knows if these got it, resending could deliver it twice
+                logging.warning(f'{e} - in send_in_batches()')
+                unknown_targets.extend(batch)
+                set_target_status(job_id,batch,'unknown')
+                return []
+        if result is not None:
+            # checkpoint as each batch lands, a restart halfway through a window must not send to these again
+            checkpoint(job_id,batch)
+            if session is not None:
+                with broadcast_lock:
+                    session.group_count+=len(batch)
+        return result
+
+    if window:
+        # about one batch every spread_interval seconds, otherwise a small send is a single batch and nothing spreads
+        slots = max(1, int(window // batch_op['spread_interval']))
+        size = max(1, min(size, -(-len(ids) // slots)))
+
+    for attempt in range(batch_op['retries'] + 1):
+        if session is not None and session.terminate:
+            break
+        if attempt:
+            # retry only the rejected recipients, in smaller batches so one bad id can't sink the rest
+            size = max(1, size // batch_op['split'])
+            await asyncio.sleep(http_op['backoff'] * 2 ** attempt)
+        # re-shard every round so targets of an instance that dropped move to the remaining ones
+        shards = {}
+        for id, inst in (await asyncio.to_thread(shard_targets, unsend_targets)).items():
+            shards.setdefault(inst, []).append(id)
+        batches = [(targets[i:i + size], inst) for inst, targets in shards.items() for i in range(0, len(targets), size)]
+        # only the first round is spread over the window, retries go out straight away
+        delays = [window * index / len(batches) if window and not attempt else 0 for index in range(len(batches))]
+        results = await asyncio.gather(*(run(batch, inst, delay) for (batch, inst), delay in zip(batches, delays)))
+        unsend_targets = []
+        for (batch, _), result in zip(batches, results):
+            if result is None:
+                unsend_targets.extend(batch)
+            else:
+                message_ids.extend(result)
+        if not unsend_targets:
+            break
+    return message_ids, unsend_targets, unknown_targets
+
+def send_in_batches(ids:list,content:dict,window:float=0,session:Session=None,reference=None,job_id=None):
+    """Send one message to many recipients in concurrent batches, returning the message ids, the unsent targets
+    and the targets whose batch timed out or failed on the server, which may or may not have got it.
+    """
+    return run_async(send_in_batches_async(ids,content,window,session,reference,job_id))
+
+def get_throughput(session:Session):
+    elapsed = max(session.finished_at - session.started_at, 0.001)
+    groups = session.group_count
+    return f"{'Groups:':<10} {groups}\n{'Time:':<10} {elapsed:.1f}s\n{'Rate:':<10} {groups * 60 / elapsed:.1f} groups/min"
+
+def record_broadcast(elapsed:float, groups:int):
+    with http_lock:
+        metrics_op['broadcasts'] += 1
+        metrics_op['broadcast_seconds'] += elapsed
+        metrics_op['broadcast_groups'] += groups
+        metrics_op['last_broadcast_seconds'] = elapsed
+        metrics_op['last_groups_per_second'] = groups / elapsed if elapsed > 0 else 0.0
+
+def render_metrics() -> str:
+    """Render the counters in the Prometheus text exposition format."""
+    connections, pool_requests = get_pool_counts()
+    with sessions_lock:
+        progress = sum(session.group_count for session in session_op['sessions'].values() if session.main_loop_mood)
+    labels = [str(bucket) for bucket in http_op['latency_buckets']] + ['+Inf']
+    lines = ['# TYPE wappsender_request_duration_seconds histogram']
+    with http_lock:
+        endpoints = {endpoint: dict(stats, latency_counts=list(stats['latency_counts'])) for endpoint, stats in metrics_op['endpoints'].items()}
+        errors = dict(metrics_op['errors'])
+        broadcast_stats = {key: metrics_op[key] for key in ('broadcasts', 'broadcast_seconds', 'broadcast_groups', 'last_broadcast_seconds', 'last_groups_per_second')}
+    for endpoint, stats in sorted(endpoints.items()):
+        total = 0
+        for label, count in zip(labels, stats['latency_counts']):
+            total += count
+            lines.append(f'wappsender_request_duration_seconds_bucket{{endpoint="{endpoint}",le="{label}"}} {total}')
+        lines.append(f'wappsender_request_duration_seconds_sum{{endpoint="{endpoint}"}} {stats["sum"]:.6f}')
+        lines.append(f'wappsender_request_duration_seconds_count{{endpoint="{endpoint}"}} {stats["count"]}')
+    lines.append('# TYPE wappsender_request_bytes_total counter')
+    lines += [f'wappsender_request_bytes_total{{endpoint="{endpoint}"}} {stats["bytes"]}' for endpoint, stats in sorted(endpoints.items())]
+    lines.append('# TYPE wappsender_request_errors_total counter')
+    lines += [f'wappsender_request_errors_total{{endpoint="{endpoint}",type="{error_type}"}} {count}' for (endpoint, error_type), count in sorted(errors.items())]
+    lines += [
+        '# TYPE wappsender_connections_opened_total counter',
+        f'wappsender_connections_opened_total {connections}',
+        '# TYPE wappsender_pooled_requests_total counter',
+        f'wappsender_pooled_requests_total {pool_requests}',
+        '# TYPE wappsender_broadcasts_total counter',
+        f"wappsender_broadcasts_total {broadcast_stats['broadcasts']}",
+        '# TYPE wappsender_broadcast_duration_seconds_total counter',
+        f"wappsender_broadcast_duration_seconds_total {broadcast_stats['broadcast_seconds']:.3f}",
+        '# TYPE wappsender_broadcast_groups_total counter',
+        f"wappsender_broadcast_groups_total {broadcast_stats['broadcast_groups']}",
+        '# TYPE wappsender_last_broadcast_duration_seconds gauge',
+        f"wappsender_last_broadcast_duration_seconds {broadcast_stats['last_broadcast_seconds']:.3f}",
+        '# TYPE wappsender_last_broadcast_groups_per_second gauge',
+        f"wappsender_last_broadcast_groups_per_second {broadcast_stats['last_groups_per_second']:.3f}",
+        '# TYPE wappsender_broadcast_progress_groups gauge',
+        f"wappsender_broadcast_progress_groups {progress}",
+        '# TYPE wappsender_executor_queue_depth gauge',
+        f'wappsender_executor_queue_depth {executor._work_queue.qsize()}',
+        '# TYPE wappsender_send_rate gauge',
+    ]
+    lines += [f'wappsender_send_rate{{instance="{inst.id}",bucket="{name}"}} {bucket.rate:.3f}' for inst in instance_pool for name, bucket in inst.buckets.items()]
+    lines.append('# TYPE wappsender_ultramsg_queue gauge')
+    lines += [f'wappsender_ultramsg_queue{{instance="{inst.id}"}} {inst.queue}' for inst in instance_pool]
+    with update_lock:
+        updates = dict(update_op, latency_counts=list(update_op['latency_counts']), queued=sum(len(queue) for queue in update_op['queues'].values()))
+    lines += ['# TYPE wappsender_update_queue_depth gauge', f"wappsender_update_queue_depth {updates['queued']}"]
+    lines.append('# TYPE wappsender_updates_total counter')
+    lines += [f'wappsender_updates_total{{result="{result}"}} {updates[result]}' for result in ('received', 'duplicates', 'processed', 'failed')]
+    lines.append('# TYPE wappsender_update_duration_seconds histogram')
+    total = 0
+    for label, count in zip(labels, updates['latency_counts']):
+        total += count
+        lines.append(f'wappsender_update_duration_seconds_bucket{{le="{label}"}} {total}')
+    lines.append(f"wappsender_update_duration_seconds_sum {updates['duration_seconds']:.6f}")
+    lines.append(f"wappsender_update_duration_seconds_count {updates['processed'] + updates['failed']}")
+    lines += ['# TYPE wappsender_update_wait_seconds_total counter', f"wappsender_update_wait_seconds_total {updates['wait_seconds']:.6f}"]
+    lines.append('# TYPE wappsender_instance_connected gauge')
+    lines += [f'wappsender_instance_connected{{instance="{inst.id}"}} {int(inst.connected)}' for inst in instance_pool]
+    lines.append('# TYPE wappsender_circuit_open gauge')
+    lines += [f'wappsender_circuit_open{{instance="{inst.id}"}} {int(inst.breaker.state != "closed")}' for inst in instance_pool]
+    return '\n'.join(lines) + '\n'
+
+def probe_instances() -> bool:
+    """Check every unavailable instance through its /groups listing, returning True once any instance can send again."""
+    for inst in instance_pool:
+        if not inst.available():
+            try:
+                fetch_groups(inst)
+                logging.info(f'instance {inst.id} passed the health probe')
+            except Exception as e:
+                logging.info(f'{e} - in probe_instances()')
+    return any_instance_available()
+
+def set_job_status(job_id, status:str):
+    if job_id is not None:
+        with jobs_lock, jobs_db:
+            jobs_db.execute('UPDATE jobs SET status = ?, updated_at = ? WHERE id = ?', (status, time.time(), job_id))
+
+def pause_for_instance(session:Session, job_id, reason) -> bool:
+    """Hold the broadcast until an instance passes a health probe, returning False if it was terminated meanwhile.
+
+    A send without a job (option "3") runs inline under the session lock and is never held, it fails straight away.
+    """
+    if job_id is None:
+        return False
+    user_id = session.chat_id
+    paused_at = time.monotonic()
+    set_job_status(job_id, 'paused')
+    send_txt_message(user_id, f'Broadcast paused at {session.group_count}/{session.groups_len} groups, WhatsApp is not reachable: {reason}\n'
+                              'It resumes automatically once the instance is back, /terminate stops it.')
+    probed_at = 0
+    while not session.terminate:
+        if time.monotonic() - probed_at >= circuit_op['probe_interval']:
+            probed_at = time.monotonic()
+            if probe_instances():
+                set_job_status(job_id, 'running')
+                send_txt_message(user_id, f'WhatsApp is reachable again after {format_duration(time.monotonic() - paused_at)}, resuming the broadcast.')
+                return True
+        time.sleep(1)
+    return False
+
+def report_incomplete(user_id, unsent:list, partial:list, unknown:list):
+    """Send the operator the targets that did not get the whole broadcast, one per line."""
+    sections = []
+    if unsent:
+        sections.append('unsend targets:\n' + '\n'.join(unsent))
+    if partial:
+        sections.append('partly sent targets, resend only the rest:\n' + '\n'.join(partial))
+    if unknown:
+        sections.append('unknown targets, the send timed out or failed on the server, check before resending:\n' + '\n'.join(unknown))
+    send_long_message(user_id, '\n\n'.join(sections))
+
+def broadcast(ids:list,content:dict,session:Session,job_id=None,window:float=0) -> bool:
+    """Send the content to every target, returning True if it was stopped by /terminate."""
+    user_id = session.chat_id
+    session.started_at=time.monotonic()
+    terminated = False
     try:
         file_count=len(content['files'])
         caption = content.get('text', '')
-        if file_count==0 and caption!=None:
-            send_text(','.join(ids),caption)
-        
-        elif file_count==1:
-            targets_string = ','.join(ids)
-            (file_type, file_content),= content['files'][0].items()
-            if file_type=='videos':
-                send_video(targets_string,caption,file_content)
-            elif file_type=='photos':
-                send_image(targets_string,caption,file_content)
-            elif file_type=='documents':
-                (doc_name, doc_link),=file_content.items()
-                send_document(targets_string,caption,doc_link,doc_name)
+        if file_count==1 or file_count==0 and caption!=None:
+            session.groups_len=len(ids)
+            message_ids, unsend_targets, unknown_targets = send_in_batches(ids,content,window,session,delivery_reference(user_id,job_id),job_id)
+            # batches left over because every instance is down are retried once one comes back, not reported as failed
+            while unsend_targets and not any_instance_available() and pause_for_instance(session, job_id, 'all instances are unavailable'):
+                more_ids, unsend_targets, more_unknown = send_in_batches(unsend_targets,content,0,session,delivery_reference(user_id,job_id),job_id)
+                message_ids += more_ids
+                unknown_targets += more_unknown
+            if not delivery_op['enabled']:
+                buffer_message_ids(user_id,message_ids)
+            session.group_count=len(ids)-len(unsend_targets)-len(unknown_targets)
+            if session.terminate:
+                # terminate() clears the flag when it is done, so remember it for the caller
+                terminated = True
+                executor.submit(terminate,session)
+                send_txt_message(user_id,'Termination process initiated!!!!')
+            elif unsend_targets or unknown_targets:
+                report_incomplete(user_id, unsend_targets, [], unknown_targets)
+                logging.info(unsend_targets + unknown_targets)
+                raise BroadcastIncomplete(f'{session.group_count} of {len(ids)} targets sent, '
+                                          f'{len(unsend_targets)} unsent, {len(unknown_targets)} unknown')
         
         elif file_count>1:
-            broadcast_op['groups_len']=len(ids)
-            for id in ids:
-                if broadcast_op['terminate']:
-                    executor.submit(terminate,user_id)
-                    send_txt_message(user_id,'Termination process initiated!!!!')
-                    break
-                else:
-                    for file in content['files']:
-                        if broadcast_op['terminate']:
-                            break
-                        else:
-                            (file_type, file_content),= file.items()
-                            if file_type=='videos':
-                                send_video(id,'',file_content)
-                            elif file_type=='photos':
-                                send_image(id,'',file_content)
-                            elif file_type=='documents':
-                                (doc_name, doc_link),=file_content.items()
-                                send_document(id,'',doc_link,doc_name)
-                    if 'text' in content and content['text']!=None:
-                        send_text(id,content['text'])
-                    broadcast_op['group_count']+=1
+            session.groups_len=len(ids)
+            progress, failed = {}, {}
+            unsend_targets, error = fan_out(ids,content,session,job_id,window,progress,failed)
+            # an outage of every instance is waited out, groups cut short carry on from the step they reached
+            while (isinstance(error, InstanceUnavailable) and unsend_targets and not any_instance_available()
+                   and pause_for_instance(session, job_id, error)):
+                unsend_targets, error = fan_out(unsend_targets,content,session,job_id,0,progress,failed)
+            if session.terminate:
+                # terminate() clears the flag when it is done, so remember it for the caller
+                terminated = True
+                executor.submit(terminate,session)
+                send_txt_message(user_id,'Termination process initiated!!!!')
+            elif unsend_targets or failed:
+                steps = group_steps(content)
+                # resending partly sent groups in full would duplicate the files they already got
+                partial = [id for id in unsend_targets if progress.get(id)]
+                partial += [id for id, reason in failed.items() if reason == 'rejected' and progress.get(id)]
+                report_incomplete(user_id,
+                                  [id for id in unsend_targets if not progress.get(id)]
+                                  + [id for id, reason in failed.items() if reason == 'rejected' and not progress.get(id)],
+                                  [f'{id}: {progress[id]}/{steps} sent' for id in partial],
+                                  [f'{id}: {progress.get(id, 0)}/{steps} sent, step {progress.get(id, 0) + 1} unknown'
+                                   for id, reason in failed.items() if reason == 'unknown'])
+                logging.info(unsend_targets + list(failed))
+                if error is not None and not isinstance(error, InstanceUnavailable):
+                    raise error
+                raise BroadcastIncomplete(f'{session.group_count} of {len(ids)} groups sent, {len(unsend_targets)} unsent, '
+                                          f'{list(failed.values()).count("rejected")} rejected, {list(failed.values()).count("unknown")} unknown')
+            elif error is not None:
+                raise error
     
+    except BroadcastIncomplete:
+        raise
     except Exception as e:
-        if file_count>1:
-            error_index=ids.index(id)
-            unsend_targets=ids[error_index:]
-            send_txt_message(user_id,f'unsend targets:\n{unsend_targets}')
-            logging.info(unsend_targets)
         raise WappSenderError(f'{e} - in broadcast()')
+    finally:
+        session.finished_at=time.monotonic()
+        record_broadcast(session.finished_at - session.started_at, session.group_count)
+        flush_message_ids()
+    return terminated
+
+def fetch_statistics(inst:Instance=None):
+    inst = inst or primary_instance()
+    url = f"{inst.api_url}/messages/statistics"
+    querystring = {"token": inst.token}
+    response = http_request("GET", url, headers={'content-type': 'application/json'}, params=querystring)
+    logging.debug(response.text)
+    return response.json()['messages_statistics']
 
-def delete_messages(msgId:str):
-    try:
-        url = f"https://api.ultramsg.com/{instance}/messages/delete"
-        payload = json.dumps({
-            "token": wapp_token,
-            "msgId": msgId})
-        response = requests.request("POST", url, headers={'Content-Type': 'application/json'}, data=payload, timeout=10)
-        logging.info(response.text)
-        return response.json()
-    except Exception as e:
-        raise WappSenderError(f'{e} - in delete_messages()')
-    
 def get_statistics():
     try:
-        url = f"https://api.ultramsg.com/{instance}/messages/statistics"
-        querystring = {"token": wapp_token}
-        response = requests.request("GET", url, headers={'content-type': 'application/json'}, params=querystring, timeout=10)
-        logging.info(response.text)
-        message_stats = response.json()['messages_statistics']
+        totals = {'sent': 0, 'queue': 0, 'unsent': 0, 'invalid': 0, 'expired': 0}
+        queues = []
+        errors = []
+        for inst in instance_pool:
+            try:
+                message_stats = fetch_statistics(inst)
+            except Exception as e:
+                errors.append(e)
+                queues.append(f"{inst.id + ':':<10} unreachable")
+                continue
+            for key in totals:
+                totals[key] += int(message_stats[key])
+            queues.append(f"{inst.id + ':':<10} {message_stats['queue']} queued{'' if inst.connected else ' (not connected)'}")
+        if len(errors) == len(instance_pool):
+            raise errors[0]
         txt_message = (
             f"Statistics:\n"
-            f"{'Sent:':<10} {message_stats['sent']}\n"
-            f"{'Queue:':<8} {message_stats['queue']}\n"
-            f"{'Unsent:':<8} {message_stats['unsent']}\n"
-            f"{'Invalid:':<10} {message_stats['invalid']}\n"
-            f"{'Expired:':<8} {message_stats['expired']}"
+            f"{'Sent:':<10} {totals['sent']}\n"
+            f"{'Queue:':<8} {totals['queue']}\n"
+            f"{'Unsent:':<8} {totals['unsent']}\n"
+            f"{'Invalid:':<10} {totals['invalid']}\n"
+            f"{'Expired:':<8} {totals['expired']}"
         )
+        if len(instance_pool) > 1:
+            txt_message += '\n\nInstances:\n' + '\n'.join(queues)
         return txt_message
     except Exception as e:
         raise WappSenderError(f'{e} - in get_statistics()')
-        
-@lru_cache(maxsize=1)        
+
+def fetch_groups(inst:Instance):
+    """Fetch one instance's groups, recording its membership and whether it is connected."""
+    url = f"{inst.api_url}/groups"
+    querystring = {"token": inst.token}
+    response = http_request("GET", url, headers={'Content-Type': 'application/json'}, params=querystring)
+    groups=response.json()
+    if 'error' in groups:
+        mark_disconnected(inst, groups['error'])
+        raise WappSenderError(f'instance {inst.id} is not connected')
+    inst.connected = True
+    inst.breaker.success()
+    inst.groups = frozenset(group['id'] for group in groups)
+    return groups
+
+@ttl_cache(cache_op['groups_ttl'])
 def get_groups_dict():
     try:
-        url = f"https://api.ultramsg.com/{instance}/groups"
-        querystring = {"token": wapp_token}
-        response = requests.request("GET", url, headers={'Content-Type': 'application/json'}, params=querystring, timeout=10)
-        groups=response.json()
         groups_dict={}
-        if 'error' in groups:
-            raise WappSenderError('instance is not connected')
-        else:
+        errors=[]
+        for inst in instance_pool:
+            try:
+                groups = fetch_groups(inst)
+            except Exception as e:
+                errors.append(e)
+                continue
             for group in groups:
-                groups_dict[group['id']]=group['name']
-            return groups_dict
+                groups_dict.setdefault(group['id'], group['name'])
+        if len(errors) == len(instance_pool):
+            raise errors[0]
+        return groups_dict
     except Exception as e:
         raise WappSenderError(f'{e} - in get_groups_dict()')
 
+class GroupIndex:
+    """Numbered view of one groups directory, sorted by name so numbers stay put until the directory changes."""
+    __slots__ = ('ids', 'names', 'folded', 'numbers')
+
+    def __init__(self, groups:dict):
+        order = sorted(groups.items(), key=lambda item: (item[1].casefold(), item[0]))
+        self.ids = [id for id, _ in order]
+        self.names = [name for _, name in order]
+        self.folded = [name.casefold() for name in self.names]
+        self.numbers = {id: number for number, id in enumerate(self.ids, 1)}
+
+    def name(self, number:int) -> str:
+        return self.names[number - 1]
+
+    def prefix(self, text:str) -> list:
+        """Numbers of the groups whose name starts with text, found by bisecting the sorted names."""
+        text = text.casefold()
+        numbers = []
+        for position in range(bisect_left(self.folded, text), len(self.folded)):
+            if not self.folded[position].startswith(text):
+                break
+            numbers.append(position + 1)
+        return numbers
+
+    def search(self, text:str) -> list:
+        """Prefix matches first, then groups with text anywhere in their name."""
+        numbers = self.prefix(text)
+        seen = set(numbers)
+        text = text.casefold()
+        return numbers + [position + 1 for position, name in enumerate(self.folded) if text in name and position + 1 not in seen]
+
+def get_group_index() -> GroupIndex:
+    """Return the index of the current groups directory, building it only when the directory was reloaded."""
+    groups = get_groups_dict()
+    with index_lock:
+        if index_op['groups'] is not groups:
+            index_op['index'] = GroupIndex(groups)
+            index_op['groups'] = groups
+        return index_op['index']
+
 def clear_messages(status):
     try:
-        url = f"https://api.ultramsg.com/{instance}/messages/clear"
-        payload = json.dumps({"token": wapp_token, "status": status})
-        response=requests.post(url, headers={'Content-Type': 'application/json'}, data=payload, timeout=10)
-        logging.info(response.text)
+        for inst in instance_pool:
+            url = f"{inst.api_url}/messages/clear"
+            payload = json.dumps({"token": inst.token, "status": status})
+            response=http_request("POST", url, headers={'Content-Type': 'application/json'}, data=payload)
+            logging.debug(response.text)
     except Exception as e:
         raise WappSenderError(f'{e} - in clear_messages()')
 
-def terminate(user_id):
+def wait_for_queue_drain():
+    """Poll every instance queue until they are empty or terminate_drain_timeout passes."""
+    deadline = time.monotonic() + terminate_op['drain_timeout']
+    while time.monotonic() < deadline:
+        try:
+            if all(int(fetch_statistics(inst)['queue']) == 0 for inst in instance_pool):
+                return True
+        except Exception as e:
+            logging.warning(f'{e} - in wait_for_queue_drain()')
+        time.sleep(terminate_op['poll_interval'])
+    return False
+
+async def delete_message_async(msgId:str):
+    inst, message_id = parse_message_ref(msgId)
+    try:
+        # same pacing, 429 retries and circuit breaker as the sends
+        response = await ultramsg_send_async('delete', {"msgId": message_id}, inst)
+        return response.status_code < 400 and 'error' not in response.json()
+    except CircuitOpen:
+        return False
+    except Exception as e:
+        logging.warning(f'{type(e).__name__}: {e} - in delete_message_async({msgId})')
+        return False
+
+async def delete_messages_bulk_async(message_ids:list,user_id):
+    limit = asyncio.Semaphore(async_op['fanout'])
+    step = max(1, int(len(message_ids) * terminate_op['progress_step']))
+    deleted = []
+    failed = []
+    progress = []
+
+    async def run(msgId):
+        async with limit:
+            ok = await delete_message_async(msgId)
+        (deleted if ok else failed).append(msgId)
+        done = len(deleted) + len(failed)
+        if done % step == 0 and done < len(message_ids):
+            progress.append(asyncio.ensure_future(send_txt_message_async(user_id, f'Deleted {done}/{len(message_ids)} messages')))
+
+    await asyncio.gather(*(run(msgId) for msgId in message_ids))
+    await asyncio.gather(*progress)
+    return deleted, failed
+
+def delete_messages_bulk(message_ids:list,user_id):
+    """Delete many messages concurrently, reporting progress to the operator, and return the deleted and failed ids."""
+    return run_async(delete_messages_bulk_async(message_ids,user_id))
+
+def terminate(session:Session):
+    user_id = session.chat_id
     try:
-        clear_content()
-        clear_messages("queue")
-        clear_messages("sent")   
-        time.sleep(5)
-        value = db.collection('WappSender').document('message-ids').get().get('ids')
-        for msgId in value:
-            delete_messages(msgId)
+        clear_content(session)
+        with sessions_lock:
+            others_busy = any(other.main_loop_mood for other in session_op['sessions'].values() if other is not session)
+        if others_busy:
+            # the instance queues are shared, leave them alone while another chat is still broadcasting
+            send_txt_message(user_id,'Another broadcast is running, only messages from this chat will be deleted.')
+        else:
+            clear_messages("queue")
+            clear_messages("sent")   
+            if not wait_for_queue_drain():
+                send_txt_message(user_id,'The queue is still not empty, deleting the sent messages anyway.')
+        message_ids = get_message_ids(user_id)
+        send_txt_message(user_id,f'Deleting {len(message_ids)} messages...')
+        deleted, failed = delete_messages_bulk(message_ids,user_id)
+        remove_message_ids(user_id,deleted)
+        if failed:
+            # the ids stay stored for the retry, listing them would overflow Telegram's message limit
+            send_txt_message(user_id,f'Could not delete {len(failed)} messages, use /terminate again to retry.')
         send_txt_message(user_id,'Termination process completed')
-        broadcast_op['main_loop_mood'] = False
-        broadcast_op['terminate']=False
+        session.main_loop_mood = False
+        session.terminate=False
     except Exception as e:
-        broadcast_op['main_loop_mood'] = False
-        broadcast_op['terminate']=False
+        session.main_loop_mood = False
+        session.terminate=False
         send_txt_message(user_id, f'Error: {e} - in terminate()')
+    save_session(session)
+
+def get_db():
+    """Return the Firestore client, building it on first use so importing main.py needs neither credentials nor grpc."""
+    if firestore_op['client'] is None:
+        with firestore_init_lock:
+            if firestore_op['client'] is None:
+                import firebase_admin
+                from firebase_admin import credentials, firestore
+                try:
+                    firebase_admin.get_app()
+                except ValueError:
+                    firebase_admin.initialize_app(credentials.Certificate(firestore_op['key_file']))
+                firestore_op['client'] = firestore.client()
+    return firestore_op['client']
+
+def update_array(document:str, transform:str, values:list):
+    """Apply an ArrayUnion/ArrayRemove (named by `transform`) for many values in one batched commit."""
+    db = get_db()
+    from firebase_admin.firestore import firestore as fs
+    transform = getattr(fs, transform)
+    doc = db.collection('WappSender').document(document)
+    batch = db.batch()
+    size = firestore_op['chunk_size']
+    for i in range(0, len(values), size):
+        batch.update(doc, {'ids': transform(values[i:i + size])})
+    batch.commit()
+
+def exclude_groups(group_ids:list):
+    if group_ids:
+        update_array('exclude_user', 'ArrayUnion', list(dict.fromkeys(group_ids)))
+    get_excluded_users.cache_clear()
+
+def include_groups(group_ids:list):
+    if group_ids:
+        update_array('exclude_user', 'ArrayRemove', list(dict.fromkeys(group_ids)))
+    get_excluded_users.cache_clear()
+
+def message_ids_document(chat_id) -> str:
+    return f'message-ids-{chat_id}'
+
+def buffer_message_ids(chat_id, message_ids:list):
+    """Queue message ids for the chat's message-ids document, flushing in the background every flush_size ids or flush_interval seconds."""
+    if not message_ids:
+        return
+    with firestore_lock:
+        buffer = firestore_op['buffers'].setdefault(chat_id, [])
+        buffer.extend(message_ids)
+        due = (len(buffer) >= firestore_op['flush_size']
+               or time.monotonic() - firestore_op['flushed_at'] >= firestore_op['flush_interval'])
+        if due:
+            firestore_op['flushed_at'] = time.monotonic()
+    if due:
+        executor.submit(flush_message_ids)
+
+def flush_message_ids():
+    # held for the whole write, so get_message_ids() can't read the document while another flush still has its ids in hand
+    with firestore_flush_lock:
+        with firestore_lock:
+            buffers, firestore_op['buffers'] = firestore_op['buffers'], {}
+            firestore_op['flushed_at'] = time.monotonic()
+        for chat_id, message_ids in buffers.items():
+            try:
+                if message_ids:
+                    update_array(message_ids_document(chat_id), 'ArrayUnion', message_ids)
+            except Exception as e:
+                with firestore_lock:
+                    firestore_op['buffers'].setdefault(chat_id, [])[:0] = message_ids
+                logging.warning(f'{e} - in flush_message_ids()')
+
+def reset_message_ids(chat_id):
+    with firestore_lock:
+        firestore_op['buffers'].pop(chat_id, None)
+    get_db().collection('WappSender').document(message_ids_document(chat_id)).set({'ids': []}, merge=True)
 
-@lru_cache(maxsize=1)        
+def get_message_ids(chat_id) -> list:
+    flush_message_ids()
+    return list(get_db().collection('WappSender').document(message_ids_document(chat_id)).get().get('ids') or [])
+
+def remove_message_ids(chat_id, message_ids:list):
+    if message_ids:
+        update_array(message_ids_document(chat_id), 'ArrayRemove', message_ids)
+
+@ttl_cache(cache_op['exclusions_ttl'])
 def get_excluded_users():
     try:
-        excluded_user = db.collection('WappSender').document('exclude_user').get().get('ids')
-        return list(excluded_user)
+        excluded_user = get_db().collection('WappSender').document('exclude_user').get().get('ids')
+        return frozenset(excluded_user)
     except Exception as e:
         raise WappSenderError(f'{e} - in get_excluded_users()')
 # -----------------------------------------------------------
@@ -254,77 +1423,632 @@ def bytes_to_mb(byte_size: int) -> float:
     """Convert bytes to megabytes, rounded to two decimal places."""
     return round(byte_size / (1024 * 1024), 2)
 
-def get_file_path(id:str):
-    url = f"{telegram_api_url}/getFile?file_id={id}"
-    response = requests.get(url)
-    file_info = response.json()
-    if file_info['ok']:
-        file_path = file_info['result']['file_path']
-        file_url = f"https://api.telegram.org/file/bot{bot_token}/{file_path}"
-        return file_url
+def relay_media(file_url:str, file_unique_id:str):
+    """Stream a Telegram file once into the local content-addressed cache and return its relay URL."""
+    with media_lock:
+        name = media_op['files'].get(file_unique_id)
+    if name is not None and os.path.exists(os.path.join(media_op['cache_dir'], name)):
+        os.utime(os.path.join(media_op['cache_dir'], name))  # in use again, keep it out of the age-based cleanup
     else:
-        raise WappSenderError(f"\n{file_info['description']}")
+        os.makedirs(media_op['cache_dir'], exist_ok=True)
+        digest = hashlib.sha256()
+        with tempfile.NamedTemporaryFile(dir=media_op['cache_dir'], suffix='.part', delete=False) as temp:
+            try:
+                with http_request("GET", file_url, stream=True) as response:
+                    response.raise_for_status()
+                    for chunk in response.iter_content(chunk_size=media_op['chunk_size']):
+                        digest.update(chunk)
+                        temp.write(chunk)
+            except BaseException:
+                temp.close()
+                os.remove(temp.name)
+                raise
+        name = digest.hexdigest() + os.path.splitext(file_url)[1].lower()
+        path = os.path.join(media_op['cache_dir'], name)
+        if os.path.exists(path):
+            os.remove(temp.name)  # identical upload already cached
+            os.utime(path)
+        else:
+            os.replace(temp.name, path)
+        with media_lock:
+            media_op['files'][file_unique_id] = name
+        prune_media_cache(keep=name)
+    return f"{media_op['relay_url']}/media/{name}"
 
-def send_txt_message(chat_id, text):
+def prune_media_cache(keep:str=None):
+    """Remove relayed files unused for max_age, then the least recently used ones until the cache fits in max_mb."""
+    try:
+        entries = []
+        for entry in os.scandir(media_op['cache_dir']):
+            if entry.is_file():
+                entries.append((entry.stat().st_mtime, entry.stat().st_size, entry.name))
+    except FileNotFoundError:
+        return
+    now = time.time()
+    total = sum(size for _, size, name in entries if not name.endswith('.part'))
+    for mtime, size, name in sorted(entries):
+        if name == keep:
+            continue
+        expired = now - mtime > media_op['max_age']
+        # downloads still in progress are only removed once they are too old to be anything but left over
+        if expired or not name.endswith('.part') and total > media_op['max_mb'] * 1024 * 1024:
+            try:
+                os.remove(os.path.join(media_op['cache_dir'], name))
+            except OSError as e:
+                logging.warning(f'{e} - in prune_media_cache()')
+                continue
+            if not name.endswith('.part'):
+                total -= size
+
+async def send_txt_message_async(chat_id, text):
     try:
         payload = {
             'chat_id': chat_id,
             'text': str(text),
         }
-        return requests.post(f"{telegram_api_url}/sendMessage", json=payload).json()
+        response = await async_request('telegram', "POST", f"{telegram_api_url}/sendMessage", json=payload)
+        return response.json()
     except Exception as e:
         logging.error(f"Error: {e} occurred while send_txt_message()")
 
-def clear_content():
-    upload_content_op.update({
-        'upload_content_mode':False,
-        'content': {'files':[],}
-    })
-    exclude_op.update({'exclude_mode':False})
-
-    broadcast_op.update({
-        'broadcast_mode': False,
-        'group_count': 0,
-        'groups_len': 0,
-        'main_loop_mood': False
-    })
-
-def send_in_background(target_ids, content, user_id, success_message):
-    broadcast_op['main_loop_mood'] = True
+def send_txt_message(chat_id, text):
+    return run_async(send_txt_message_async(chat_id, text))
+
+async def telegram_call_async(method:str, payload:dict):
+    try:
+        response = await async_request('telegram', "POST", f"{telegram_api_url}/{method}", json=payload)
+        return response.json()
+    except Exception as e:
+        logging.error(f"Error: {e} occurred while {method}()")
+
+def telegram_call(method:str, payload:dict):
+    return run_async(telegram_call_async(method, payload))
+
+def send_long_message(chat_id, text:str, limit:int=4000):
+    """Send text in as many messages as Telegram's 4096 character limit needs, splitting between lines."""
+    chunk = ''
+    for line in text.split('\n'):
+        if chunk and len(chunk) + len(line) + 1 > limit:
+            send_txt_message(chat_id, chunk)
+            chunk = ''
+        chunk = f'{chunk}\n{line}' if chunk else line[:limit]
+    if chunk:
+        send_txt_message(chat_id, chunk)
+
+def clear_content(session:Session):
+    session.upload_content_mode = False
+    session.content = {'files':[],}
+    session.exclude_mode = False
+    session.broadcast_mode = False
+    session.group_count = 0
+    session.groups_len = 0
+    session.main_loop_mood = False
+
+def get_session(chat_id) -> Session:
+    with sessions_lock:
+        session = session_op['sessions'].get(chat_id)
+        if session is None:
+            session = session_op['sessions'][chat_id] = load_session(chat_id)
+        return session
+
+def load_session(chat_id) -> Session:
+    session = Session(chat_id)
+    if session_op['backend'] == 'sqlite':
+        with jobs_lock:
+            row = jobs_db.execute('SELECT state FROM sessions WHERE chat_id = ?', (chat_id,)).fetchone()
+        if row is not None:
+            for name, value in json.loads(row[0]).items():
+                if name in Session.persisted:
+                    setattr(session, name, value)
+    return session
+
+def save_session(session:Session):
+    if session_op['backend'] == 'sqlite':
+        state = json.dumps({name: getattr(session, name) for name in Session.persisted})
+        with jobs_lock, jobs_db:
+            jobs_db.execute('INSERT OR REPLACE INTO sessions (chat_id, state) VALUES (?, ?)', (session.chat_id, state))
+
+def init_jobs_db():
+    with jobs_lock, jobs_db:
+        jobs_db.executescript('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                content TEXT NOT NULL,
+                success_message TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'running',
+                window REAL NOT NULL DEFAULT 0,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS job_targets (
+                job_id INTEGER NOT NULL,
+                position INTEGER NOT NULL,
+                target TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                PRIMARY KEY (job_id, target)
+            );
+            CREATE TABLE IF NOT EXISTS sessions (
+                chat_id INTEGER PRIMARY KEY,
+                state TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS schedules (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                audience TEXT NOT NULL,
+                content TEXT NOT NULL,
+                run_at REAL NOT NULL,
+                window REAL NOT NULL DEFAULT 0,
+                status TEXT NOT NULL DEFAULT 'scheduled',
+                created_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS deliveries (
+                msg_id TEXT PRIMARY KEY,
+                instance TEXT NOT NULL,
+                target TEXT NOT NULL,
+                chat_id INTEGER,
+                job_id INTEGER,
+                status TEXT NOT NULL,
+                rank INTEGER NOT NULL,
+                updated_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS deliveries_job ON deliveries (job_id);
+        ''')
+        if 'window' not in {row[1] for row in jobs_db.execute('PRAGMA table_info(jobs)')}:
+            jobs_db.execute('ALTER TABLE jobs ADD COLUMN window REAL NOT NULL DEFAULT 0')  # databases from before windowed jobs
+
+def create_job(user_id, content:dict, target_ids:list, success_message:str, window:float=0):
+    now = time.time()
+    with jobs_lock, jobs_db:
+        cursor = jobs_db.execute(
+            'INSERT INTO jobs (user_id, content, success_message, window, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)',
+            (user_id, json.dumps(content), success_message, window, now, now))
+        job_id = cursor.lastrowid
+        jobs_db.executemany('INSERT OR IGNORE INTO job_targets (job_id, position, target) VALUES (?, ?, ?)',
+                            [(job_id, position, target) for position, target in enumerate(target_ids)])
+    return job_id
+
+def checkpoint(job_id, targets:list):
+    """Record served targets, writing them out every checkpoint_size targets or checkpoint_interval seconds."""
+    if job_id is None:
+        return
+    with jobs_lock:
+        job_op['served'].extend((job_id, target) for target in targets)
+        due = (len(job_op['served']) >= job_op['checkpoint_size']
+               or time.monotonic() - job_op['checkpointed_at'] >= job_op['checkpoint_interval'])
+    if due:
+        flush_checkpoint()
+
+def flush_checkpoint():
+    with jobs_lock, jobs_db:
+        served, job_op['served'] = job_op['served'], []
+        job_op['checkpointed_at'] = time.monotonic()
+        jobs_db.executemany("UPDATE job_targets SET status = 'sent' WHERE job_id = ? AND target = ?", served)
+
+def set_target_status(job_id, targets:list, status:str):
+    """Record targets that are neither sent nor pending ('unknown', 'partial'), so a resume leaves them to the operator."""
+    if job_id is None:
+        return
+    with jobs_lock, jobs_db:
+        jobs_db.executemany("UPDATE job_targets SET status = ? WHERE job_id = ? AND target = ?",
+                            [(status, job_id, target) for target in targets])
+
+def finish_job(job_id, status:str):
+    flush_checkpoint()
+    with jobs_lock, jobs_db:
+        jobs_db.execute('UPDATE jobs SET status = ?, updated_at = ? WHERE id = ?', (status, time.time(), job_id))
+
+def get_pending_targets(job_id) -> list:
+    with jobs_lock:
+        rows = jobs_db.execute(
+            "SELECT target FROM job_targets WHERE job_id = ? AND status = 'pending' ORDER BY position", (job_id,)).fetchall()
+    return [row[0] for row in rows]
+
+def delivery_reference(chat_id, job_id) -> str:
+    return f'wappsender:{chat_id}:{job_id or 0}'
+
+def delivery_owner(event:dict):
+    """Return the (chat_id, job_id) from a wappsender referenceId, or (None, None) for messages we didn't send.
+
+    Anything else, e.g. a message typed on the phone into a broadcast group, must never end up in the ids /terminate deletes.
+    """
+    match = re.fullmatch(r'wappsender:(-?\d+):(\d+)', str(event.get('referenceId') or ''))
+    if match:
+        return int(match.group(1)), int(match.group(2)) or None
+    return None, None
+
+def event_instance(event:dict) -> Instance:
+    instance_id = str(event.get('instanceId') or '')
+    return instance_by_id.get(instance_id) or instance_by_id.get(f'instance{instance_id}') or instance_pool[0]
+
+def record_delivery(event:dict) -> bool:
+    """Store one UltraMsg message_create/message_ack event in the deliveries index."""
+    if not isinstance(event, dict):
+        return False
+    data = event.get('data') or {}
+    if event.get('event_type') not in ('message_create', 'message_ack') or not data.get('fromMe') or not data.get('id'):
+        return False
+    status = str(data.get('ack') or 'created').lower()
+    rank = delivery_op['ranks'].get(status, 0)
+    msg_id, target = str(data['id']), str(data.get('to') or '')
+    inst = event_instance(event)
+    chat_id, job_id = delivery_owner(event)
+    with jobs_lock, jobs_db:
+        row = jobs_db.execute('SELECT chat_id FROM deliveries WHERE msg_id = ?', (msg_id,)).fetchone()
+        if row is None:
+            jobs_db.execute(
+                'INSERT INTO deliveries (msg_id, instance, target, chat_id, job_id, status, rank, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (msg_id, inst.id, target, chat_id, job_id, status, rank, time.time()))
+        else:
+            # acks can arrive out of order, never move a message back to an earlier state
+            jobs_db.execute('UPDATE deliveries SET status = ?, rank = ?, updated_at = ? WHERE msg_id = ? AND rank < ?',
+                            (status, rank, time.time(), msg_id, rank))
+            if row[0] is None and chat_id is not None:
+                # an ack without the referenceId got here first
+                jobs_db.execute('UPDATE deliveries SET chat_id = ?, job_id = ? WHERE msg_id = ?', (chat_id, job_id, msg_id))
+        claimed = chat_id is not None and (row is None or row[0] is None)
+    if claimed and delivery_op['enabled']:
+        buffer_message_ids(chat_id, [message_ref(inst, msg_id)])
+    return True
+
+def get_delivery_status(user_id, limit:int=3) -> str:
+    """Summarise delivered/failed/pending messages of the chat's latest broadcasts from the deliveries index."""
+    delivered, failed = delivery_op['ranks']['device'], delivery_op['ranks']['error']
+    lines = []
+    with jobs_lock:
+        jobs = jobs_db.execute('SELECT id, status, created_at FROM jobs WHERE user_id = ? ORDER BY id DESC LIMIT ?', (user_id, limit)).fetchall()
+        for job_id, status, created_at in jobs:
+            groups = jobs_db.execute('SELECT COUNT(*) FROM job_targets WHERE job_id = ?', (job_id,)).fetchone()[0]
+            counts = jobs_db.execute(
+                'SELECT COUNT(*), SUM(rank >= ? AND rank < ?), SUM(rank >= ?), COUNT(DISTINCT CASE WHEN rank >= ? AND rank < ? THEN target END) '
+                'FROM deliveries WHERE job_id = ?', (delivered, failed, failed, delivered, failed, job_id)).fetchone()
+            total, ok, bad, reached = (value or 0 for value in counts)
+            started = datetime.fromtimestamp(created_at, schedule_op['timezone']).strftime('%Y-%m-%d %H:%M')
+            lines.append(
+                f"Broadcast {job_id} ({status}, {started}):\n"
+                f"{'Delivered:':<10} {ok}\n"
+                f"{'Failed:':<10} {bad}\n"
+                f"{'Pending:':<10} {total - ok - bad}\n"
+                f"{'Groups:':<10} {reached}/{groups} reached")
+    return '\n\n'.join(lines) if lines else 'No broadcasts yet.'
+
+def prune_deliveries():
+    with jobs_lock, jobs_db:
+        jobs_db.execute('DELETE FROM deliveries WHERE updated_at < ?', (time.time() - delivery_op['retention'],))
+
+def delivery_authorized(token) -> bool:
+    """Check the ?token= of an UltraMsg webhook call, refusing every call when no token is configured."""
+    if not delivery_op['token'] or not token:
+        return False
+    return hmac.compare_digest(str(token).encode(), delivery_op['token'].encode())
+
+def resume_jobs():
+    """Restart every job that was still running or paused when the process last stopped, within what is left of its window."""
+    with jobs_lock:
+        jobs = jobs_db.execute(
+            "SELECT id, user_id, content, success_message, window, created_at FROM jobs WHERE status IN ('running', 'paused') ORDER BY id").fetchall()
+    for job_id, user_id, content, success_message, window, created_at in jobs:
+        target_ids = get_pending_targets(job_id)
+        if not target_ids:
+            finish_job(job_id, 'done')
+            continue
+        content = json.loads(content)
+        rejected = refresh_content(content)
+        if rejected:
+            send_txt_message(user_id, f'These files of broadcast {job_id} failed the pre-flight check and were dropped:\n' + '\n'.join(rejected))
+        if not content['files'] and content.get('text') is None:
+            finish_job(job_id, 'failed')
+            send_txt_message(user_id, f'Broadcast {job_id} was not resumed, none of its content can be sent any more.')
+            continue
+        window = max(0.0, created_at + window - time.time())
+        session = get_session(user_id)
+        session.main_loop_mood = True
+        send_txt_message(user_id, f'Resuming broadcast {job_id}: {len(target_ids)} groups remaining'
+                                  + (f', spread over the remaining {format_duration(window)}.' if window else '.'))
+        executor.submit(send_in_background, target_ids, content, session, success_message, job_id, window)
+
+def send_in_background(target_ids, content, session:Session, success_message, job_id=None, window:float=0):
+    user_id = session.chat_id
+    session.main_loop_mood = True
+    session.group_count = 0
     try:
-        broadcast(target_ids,content,user_id)
-        if not broadcast_op['terminate'] and len(target_ids)!=1:
-            send_text('+917020805020','Broadcast completed.')
-            txt_message=get_statistics()
-            send_txt_message(user_id, success_message)
-            send_txt_message(user_id,txt_message)
-            clear_content()
+        if job_id is None:
+            job_id = create_job(user_id, content, target_ids, success_message, window)
+        if broadcast(target_ids,content,session,job_id,window):
+            finish_job(job_id, 'terminated')
+        elif len(target_ids)!=1:
+            finish_job(job_id, 'done')
+            try:
+                send_text('+917020805020','Broadcast completed.')
+                txt_message=get_statistics()
+                send_txt_message(user_id, success_message)
+                send_txt_message(user_id,f'{txt_message}\n\n{get_throughput(session)}')
+            except Exception as e:
+                # everything went out, a failing summary must not turn the job into a failure
+                send_txt_message(user_id, f'{success_message}\n\nError: {e} occurred while sending the broadcast summary')
+            if content is session.content:
+                # scheduled broadcasts bring their own content, leave the chat's next draft alone
+                clear_content(session)
+        else:
+            finish_job(job_id, 'done')
+    except BroadcastIncomplete as e:
+        # the rest went out, the targets to look at are already with the operator
+        finish_job(job_id, 'incomplete')
+        send_txt_message(user_id, f'Broadcast incomplete: {e}')
     except Exception as e:
+        if job_id is not None:
+            finish_job(job_id, 'failed')
         send_txt_message(user_id, f'Error: {e} - in send_in_background()')
-    broadcast_op['main_loop_mood'] = False
+    session.main_loop_mood = False
+    save_session(session)
   
-def upload_document_in_background(update:dict,user_id:str):
+schedule_pattern = re.compile(r'([12])(?:\s+(at|in)\s+(.+?))?(?:\s+over\s+(.+))?', re.IGNORECASE)
+
+def parse_duration(text:str) -> float:
+    """Parse durations like 90s, 45m, 2h or 1h30m into seconds."""
+    text = text.strip().lower()
+    parts = re.findall(r'(\d+)\s*([smhd])', text)
+    if not parts or re.sub(r'(\d+)\s*([smhd])', '', text).strip():
+        raise WappSenderError(f'{text} is not a duration, use e.g. 45m, 2h or 1h30m')
+    return float(sum(int(value) * {'s':1, 'm':60, 'h':3600, 'd':86400}[unit] for value, unit in parts))
+
+def parse_time(text:str) -> float:
+    """Parse HH:MM (the next one to come) or YYYY-MM-DD HH:MM in schedule_timezone into a timestamp."""
+    timezone = schedule_op['timezone']
+    now = datetime.now(timezone)
+    try:
+        if '-' in text:
+            when = datetime.strptime(text.strip(), '%Y-%m-%d %H:%M').replace(tzinfo=timezone)
+        else:
+            clock = datetime.strptime(text.strip(), '%H:%M')
+            when = now.replace(hour=clock.hour, minute=clock.minute, second=0, microsecond=0)
+            if when <= now:
+                when += timedelta(days=1)
+    except ValueError:
+        raise WappSenderError(f'{text} is not a time, use HH:MM or YYYY-MM-DD HH:MM')
+    return when.timestamp()
+
+def parse_schedule(text:str):
+    """Parse '1 at 18:30', '2 in 2h' or '1 over 30m' (or a mix) into (audience, run_at, window)."""
+    match = schedule_pattern.fullmatch(text.strip())
+    if match is None:
+        raise WappSenderError(f'{text} is not a broadcast option')
+    audience, kind, when, window = match.groups()
+    if kind is None:
+        run_at = time.time()
+    elif kind.lower() == 'at':
+        run_at = parse_time(when)
+    else:
+        run_at = time.time() + parse_duration(when)
+    return audience, run_at, parse_duration(window) if window else 0.0
+
+def format_duration(seconds:float) -> str:
+    hours, rest = divmod(int(seconds), 3600)
+    minutes, seconds = divmod(rest, 60)
+    return ''.join(f'{value}{unit}' for value, unit in ((hours, 'h'), (minutes, 'm'), (seconds, 's')) if value) or '0s'
+
+def format_schedule(run_at:float, window:float) -> str:
+    text = datetime.fromtimestamp(run_at, schedule_op['timezone']).strftime('%Y-%m-%d %H:%M %Z')
+    return f'{text}, spread over {format_duration(window)}' if window else text
+
+def push_schedule(run_at:float, schedule_id:int):
+    with schedule_cond:
+        heapq.heappush(schedule_op['heap'], (run_at, schedule_id))
+        schedule_cond.notify()
+
+def create_schedule(user_id, audience:str, content:dict, run_at:float, window:float) -> int:
+    with jobs_lock, jobs_db:
+        cursor = jobs_db.execute(
+            'INSERT INTO schedules (user_id, audience, content, run_at, window, created_at) VALUES (?, ?, ?, ?, ?, ?)',
+            (user_id, audience, json.dumps(content), run_at, window, time.time()))
+    push_schedule(run_at, cursor.lastrowid)
+    return cursor.lastrowid
+
+def list_schedules(user_id) -> list:
+    with jobs_lock:
+        return jobs_db.execute(
+            "SELECT id, audience, run_at, window FROM schedules WHERE user_id = ? AND status = 'scheduled' ORDER BY run_at",
+            (user_id,)).fetchall()
+
+def cancel_schedule(user_id, schedule_id:int) -> bool:
+    # the timer entry stays in the heap, start_schedule skips it once it comes due
+    with jobs_lock, jobs_db:
+        return jobs_db.execute(
+            "UPDATE schedules SET status = 'cancelled' WHERE id = ? AND user_id = ? AND status = 'scheduled'",
+            (schedule_id, user_id)).rowcount == 1
+
+def load_schedules():
+    """Put every schedule that hasn't started yet back on the timer, overdue ones fire right away."""
+    with jobs_lock:
+        rows = jobs_db.execute("SELECT id, run_at FROM schedules WHERE status = 'scheduled'").fetchall()
+    for schedule_id, run_at in rows:
+        push_schedule(run_at, schedule_id)
+
+def run_scheduler():
+    """Sleep until the earliest schedule is due, waking early only when a sooner one is added."""
+    while True:
+        with schedule_cond:
+            heap = schedule_op['heap']
+            while not heap or heap[0][0] > time.time():
+                schedule_cond.wait(heap[0][0] - time.time() if heap else None)
+            _, schedule_id = heapq.heappop(heap)
+        executor.submit(start_schedule, schedule_id)
+
+def start_schedule(schedule_id:int):
+    with jobs_lock:
+        row = jobs_db.execute(
+            "SELECT user_id, audience, content, window FROM schedules WHERE id = ? AND status = 'scheduled'", (schedule_id,)).fetchone()
+    if row is None:
+        return  # cancelled, or already started by another worker
+    user_id, audience, content, window = row
+    session = get_session(user_id)
+    with session.lock:
+        busy = session.main_loop_mood
+        session.main_loop_mood = True
+    if busy:
+        run_at = time.time() + schedule_op['busy_retry']
+        with jobs_lock, jobs_db:
+            jobs_db.execute('UPDATE schedules SET run_at = ? WHERE id = ?', (run_at, schedule_id))
+        push_schedule(run_at, schedule_id)
+        send_txt_message(user_id, f'Scheduled broadcast {schedule_id} is waiting for the running broadcast to finish.')
+        return
+    with jobs_lock, jobs_db:
+        claimed = jobs_db.execute(
+            "UPDATE schedules SET status = 'started' WHERE id = ? AND status = 'scheduled'", (schedule_id,)).rowcount == 1
+    if not claimed:
+        session.main_loop_mood = False
+        return
+    try:
+        content = json.loads(content)
+        # the links resolved when it was scheduled may have expired by now
+        rejected = refresh_content(content)
+        if rejected:
+            send_txt_message(user_id, f'These files of scheduled broadcast {schedule_id} failed the pre-flight check and were dropped:\n' + '\n'.join(rejected))
+        if not content['files'] and content.get('text') is None:
+            raise WappSenderError('none of its content can be sent any more')
+        target_list = list(get_groups_dict().keys())
+        if audience == '2':
+            excluded_users = get_excluded_users()
+            target_list = [id for id in target_list if id not in excluded_users]
+        reset_message_ids(user_id)
+    except Exception as e:
+        with jobs_lock, jobs_db:
+            jobs_db.execute("UPDATE schedules SET status = 'failed' WHERE id = ?", (schedule_id,))
+        session.main_loop_mood = False
+        send_txt_message(user_id, f'Error: {e} occurred while starting scheduled broadcast {schedule_id}')
+        return
+    send_txt_message(user_id, f'Starting scheduled broadcast {schedule_id} to {len(target_list)} groups.')
+    success_message = f"Scheduled broadcast {schedule_id} has been successfully sent to {'all' if audience == '1' else 'selected'} groups."
+    send_in_background(target_list, content, session, success_message, window=window)
+
+class MediaRejected(WappSenderError):
+    """An uploaded file that can never be sent, so there is no point retrying it."""
+
+def media_limit_mb(file_type:str) -> float:
+    return min(media_op['limits'][file_type]['max_mb'], media_op['telegram_max_mb'])
+
+def validate_upload(upload:dict):
+    """Check an upload's MIME type and size against the provider limits, returning the problem or None."""
+    try:
+        file_type = categorize_mime_type(upload['mime_type'])
+    except WappSenderError:
+        return f"{upload['mime_type']} files can't be broadcast"
+    allowed = media_op['limits'][file_type]['mime']
+    if allowed and upload['mime_type'] not in allowed:
+        return f"{upload['mime_type']} is not supported for {file_type}, use {', '.join(allowed)}"
+    if bytes_to_mb(upload['file_size']) > media_limit_mb(file_type):
+        return f"File size too big: {bytes_to_mb(upload['file_size'])} MB, {file_type} are limited to {media_limit_mb(file_type)} MB"
+    return None
+
+async def get_file_path_async(id:str):
+    response = await async_request('telegram', "GET", f"{telegram_api_url}/getFile", params={'file_id': id}, timeout=media_op['timeout'])
+    file_info = response.json()
+    if file_info['ok']:
+        return f"{telegram_api_base}/file/bot{bot_token}/{file_info['result']['file_path']}"
+    if response.status_code < 500:
+        raise MediaRejected(file_info.get('description', 'Telegram refused the file'))
+    raise WappSenderError(file_info.get('description', f'getFile answered {response.status_code}'))
+
+async def check_reachable(url:str, file_type:str):
+    """HEAD the file the way UltraMsg will fetch it, checking it is there and within the size limit."""
+    response = await async_request('telegram', "HEAD", url, timeout=media_op['timeout'], follow_redirects=True)
+    if response.status_code >= 500:
+        raise WappSenderError(f'file server answered {response.status_code}')
+    if response.status_code >= 400:
+        raise MediaRejected(f'file is not reachable ({response.status_code})')
+    size = int(response.headers.get('Content-Length') or 0)
+    if bytes_to_mb(size) > media_limit_mb(file_type):
+        raise MediaRejected(f'File size too big: {bytes_to_mb(size)} MB')
+
+async def preflight_upload(upload:dict):
+    """Resolve, check and optionally relay one upload, returning (file entry, None) or (None, problem)."""
+    problem = validate_upload(upload)
+    if problem:
+        return None, problem
+    file_type = categorize_mime_type(upload['mime_type'])
+    for attempt in range(media_op['retries'] + 1):
+        if attempt:
+            await asyncio.sleep(http_op['backoff'] * 2 ** attempt)
+        try:
+            path = await get_file_path_async(upload['file_id'])
+            await check_reachable(path, file_type)
+            if media_op['relay_url']:
+                path = await asyncio.to_thread(relay_media, path, upload['file_unique_id'])
+            break
+        except MediaRejected as e:
+            return None, str(e)
+        except Exception as e:
+            problem = f'{type(e).__name__}: {e}'
+    else:
+        return None, f'not reachable after {media_op["retries"] + 1} attempts ({problem})'
+    logging.info(path)
+    if file_type == 'documents':
+        file_name = upload['file_name']
+        if file_name.endswith('.pdf'):
+            file_name = file_name[:-4]
+        return {'documents': {file_name: path}}, None
+    return {file_type: path}, None
+
+def preflight_task(upload:dict):
+    """Return the cached pre-flight of an upload, starting a new one if there is none, it expired or it failed."""
+    key = upload['file_unique_id']
+    entry = media_op['preflight'].get(key)
+    if entry is not None:
+        task, started_at = entry
+        failed = task.done() and (task.cancelled() or task.exception() is not None or task.result()[1] is not None)
+        if not failed and time.monotonic() - started_at < media_op['preflight_ttl']:
+            return task
+    now = time.monotonic()
+    for stale in [key for key, (_, started_at) in media_op['preflight'].items() if now - started_at >= media_op['preflight_ttl']]:
+        del media_op['preflight'][stale]
+    task = asyncio.ensure_future(preflight_upload(upload))
+    media_op['preflight'][key] = (task, now)
+    return task
+
+async def preflight_async(uploads:list):
+    return await asyncio.gather(*(preflight_task(upload) for upload in uploads))
+
+def preflight_content(content:dict) -> list:
+    """Resolve and check every pending upload at once, moving the good ones into the content and returning the rejected ones.
+
+    The accepted uploads are kept in content['sources'] so refresh_content() can resolve them again later.
+    """
+    uploads = content.pop('uploads', None) or []
+    rejected = []
+    for upload, (entry, problem) in zip(uploads, run_async(preflight_async(uploads))):
+        if entry is not None:
+            content['files'].append(entry)
+            content.setdefault('sources', []).append(upload)
+        else:
+            rejected.append(f"{upload.get('file_name') or upload['file_unique_id']}: {problem}")
+    return rejected
+
+def refresh_content(content:dict) -> list:
+    """Re-run the pre-flight of content saved for later, Telegram file links are only good for about an hour."""
+    if not content.get('sources'):
+        return []
+    content['files'] = []
+    content['uploads'] = content.pop('sources')
+    return preflight_content(content)
+
+def upload_document(update:dict,session:Session):
+    """Record an uploaded document for the next broadcast and start checking it in the background."""
+    user_id = session.chat_id
     try:
         file=update['message']['document']
-        file_size=file['file_size']
-        file_size_mb=bytes_to_mb(file_size)
-        if file_size_mb>15.9:
-            send_txt_message(user_id,f"File size too big: {file_size_mb} MB")
+        upload = {key: file.get(key) for key in ('file_id', 'file_unique_id', 'file_name', 'mime_type', 'file_size')}
+        upload['file_size'] = upload['file_size'] or 0
+        upload['mime_type'] = upload['mime_type'] or 'application/octet-stream'
+        problem = validate_upload(upload)
+        if problem:
+            send_txt_message(user_id, f"File rejected: {problem}")
             return
-        send_txt_message(user_id,f"Document received: {file_size_mb} MB")
-        file_id=file['file_id']
-        file_type=categorize_mime_type(file['mime_type'])
-        path=get_file_path(file_id)
-        if file_type=='documents':
-            file_name=file['file_name']
-            if file_name.endswith('.pdf'):
-                file_name = file_name[:-4]
-            upload_content_op['content']['files'].append({'documents':{file_name:path}})  
-        else:
-            upload_content_op['content']['files'].append({file_type:path})
-        logging.info(path)      
+        session.content.setdefault('uploads', []).append(upload)
+        # warm the pre-flight cache while the operator is still uploading
+        asyncio.run_coroutine_threadsafe(preflight_async([upload]), async_loop)
+        send_txt_message(user_id,f"Document received: {bytes_to_mb(upload['file_size'])} MB")
     except Exception as e:
-        send_txt_message(user_id, f'Error: {e} - in upload_document_in_background()')
+        send_txt_message(user_id, f'Error: {e} - in upload_document()')
 
 def categorize_mime_type(mime_type):
     if mime_type.startswith('image/'):
@@ -336,230 +2060,533 @@ def categorize_mime_type(mime_type):
     else:
         raise WappSenderError(f'{mime_type} not optimise for code- in categorize_mime_type()')
 
+def parse_selection(text:str, count:int) -> list:
+    """Parse group numbers and ranges like '1-40,55', checking they are between 1 and count."""
+    numbers = []
+    for part in text.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        match = re.fullmatch(r'(\d+)\s*(?:-\s*(\d+))?', part)
+        if match is None:
+            raise WappSenderError(f'{part} is not a group number or range')
+        start, end = sorted((int(match.group(1)), int(match.group(2) or match.group(1))))
+        if start < 1 or end > count:
+            raise WappSenderError(f'{part} is outside 1-{count}')
+        numbers.extend(range(start, end + 1))
+    return list(dict.fromkeys(numbers))
+
+def group_buttons(numbers, ids:list, excluded:frozenset) -> list:
+    buttons = [{'text': f"{'🚫 ' if ids[number - 1] in excluded else ''}{number}", 'callback_data': f'x:{number}'} for number in numbers]
+    return [buttons[i:i + 5] for i in range(0, len(buttons), 5)]
+
+def render_group_page(index:GroupIndex, page:int):
+    """Return the text and inline keyboard of one page of the group list."""
+    size = index_op['page_size']
+    pages = max(1, -(-len(index.ids) // size))
+    page = min(max(page, 0), pages - 1)
+    numbers = range(page * size + 1, min((page + 1) * size, len(index.ids)) + 1)
+    excluded = get_excluded_users()
+    header = f'Groups {numbers.start}-{numbers.stop - 1} of {len(index.ids)}, {sum(id in excluded for id in index.ids)} excluded' if numbers else 'No groups found'
+    text = '\n\n'.join([header, '\n'.join(f'{number}:  {index.name(number)}' for number in numbers)]).strip()
+    navigation = [{'text': f'{page + 1}/{pages}', 'callback_data': 'noop'}]
+    if page > 0:
+        navigation.insert(0, {'text': '« Prev', 'callback_data': f'p:{page - 1}'})
+    if page < pages - 1:
+        navigation.append({'text': 'Next »', 'callback_data': f'p:{page + 1}'})
+    keyboard = group_buttons(numbers, index.ids, excluded) + [navigation, [{'text': 'Done', 'callback_data': 'done'}]]
+    return text, keyboard
+
+def render_group_search(index:GroupIndex, query:str):
+    size = index_op['page_size']
+    numbers = index.search(query)
+    shown = numbers[:size]
+    header = f'{len(numbers)} groups match "{query}"' + (f', showing the first {size}' if len(numbers) > size else '')
+    text = '\n\n'.join([header, '\n'.join(f'{number}:  {index.name(number)}' for number in shown)]).strip()
+    keyboard = group_buttons(shown, index.ids, get_excluded_users())
+    keyboard.append([{'text': 'Back to list', 'callback_data': 'p:0'}, {'text': 'Done', 'callback_data': 'done'}])
+    return text, keyboard
+
+def send_excluded_summary(user_id, index:GroupIndex):
+    excluded_users = get_excluded_users()
+    excluded_groups = '\n'.join(name for id, name in zip(index.ids, index.names) if id in excluded_users)
+    send_long_message(user_id, f'Excluded groups are:\n{excluded_groups.strip()}')
+
+def handle_callback(session:Session, update:dict):
+    """Handle the buttons of the /exclude_users list: page through it, toggle a group, or finish."""
+    query = update['callback_query']
+    user_id = session.chat_id
+    data = query.get('data', '')
+    message_id = query['message']['message_id']
+    if user_id not in login_op['login_users']:
+        telegram_call('answerCallbackQuery', {'callback_query_id': query['id'], 'text': 'Please log in first using /login.'})
+        return
+    notice = None
+    try:
+        index = get_group_index()
+        if data.startswith('p:'):
+            text, keyboard = render_group_page(index, int(data[2:]))
+            session.group_ids = index.ids
+            session.exclude_mode = True
+            telegram_call('editMessageText', {'chat_id': user_id, 'message_id': message_id, 'text': text, 'reply_markup': {'inline_keyboard': keyboard}})
+        elif data.startswith('x:'):
+            number = int(data[2:])
+            ids = session.group_ids or index.ids
+            id = ids[number - 1]
+            was_excluded = id in get_excluded_users()
+            (include_groups if was_excluded else exclude_groups)([id])
+            keyboard = query['message'].get('reply_markup', {}).get('inline_keyboard', [])
+            for row in keyboard:
+                for button in row:
+                    if button.get('callback_data') == data:
+                        button['text'] = str(number) if was_excluded else f'🚫 {number}'
+            telegram_call('editMessageReplyMarkup', {'chat_id': user_id, 'message_id': message_id, 'reply_markup': {'inline_keyboard': keyboard}})
+            name = index.name(index.numbers[id]) if id in index.numbers else id
+            notice = f"{'Included' if was_excluded else 'Excluded'} {name}"
+        elif data == 'done':
+            session.exclude_mode = False
+            telegram_call('editMessageReplyMarkup', {'chat_id': user_id, 'message_id': message_id, 'reply_markup': {'inline_keyboard': []}})
+            send_excluded_summary(user_id, index)
+    except Exception as e:
+        send_txt_message(user_id, f"Error: {e} occurred while updating the excluded groups")
+    telegram_call('answerCallbackQuery', {'callback_query_id': query['id'], **({'text': notice} if notice else {})})
+
+def handle_update(session:Session, update:dict):
+    if 'callback_query' in update:
+        handle_callback(session, update)
+    else:
+        handle_message(session, update)
+
 # -----------------------------------------------------------
 
-@app.route('/', methods=['POST'])
-def webhook_post():
-    update = request.json
-    if 'message' in update:
-        user_id = update['message']['chat']['id']
+def handle_message(session:Session, update:dict):
+    user_id = session.chat_id
 
-        if 'document' in update['message'] and upload_content_op['upload_content_mode'] and not broadcast_op['main_loop_mood']:
-            try:
-                executor.submit(upload_document_in_background, update, user_id)
-            except Exception as e:
-                    send_txt_message(user_id, f"Error: {e} occurred during the document upload process")
-            return jsonify({'status': 'ok'})
-            
-        elif 'text' in update['message']:
-            text_message=update['message']['text']
+    if 'document' in update['message'] and session.upload_content_mode and not session.main_loop_mood:
+        try:
+            upload_document(update, session)
+        except Exception as e:
+                send_txt_message(user_id, f"Error: {e} occurred during the document upload process")
+        return
+        
+    elif 'text' in update['message']:
+        text_message=update['message']['text']
+        
+        if not session.main_loop_mood:
             
-            if not broadcast_op['main_loop_mood']:
+            if text_message not in bot_commands_list:
+
+                cancel_match = re.fullmatch(r'/cancel_(\d+)', text_message)
+                if cancel_match and user_id in login_op['login_users']:
+                    if cancel_schedule(user_id, int(cancel_match.group(1))):
+                        send_txt_message(user_id, f'Scheduled broadcast {cancel_match.group(1)} has been cancelled.')
+                    else:
+                        send_txt_message(user_id, f'There is no pending broadcast {cancel_match.group(1)}.')
+                    return
                 
-                if text_message not in bot_commands_list:
-                    
-                    if login_op['login_mode']:
-                        if text_message==wappsender:
-                            send_txt_message(user_id,"You are authorized to use the bot.")
-                            login_op['login_users'][user_id]=True
-                            login_op['login_mode']=False
+                if session.login_mode:
+                    if text_message==wappsender:
+                        send_txt_message(user_id,"You are authorized to use the bot.")
+                        login_op['login_users'][user_id]=True
+                        session.login_mode=False
+                    else:
+                        send_txt_message(user_id,"Invalid password. Please try again:")
+                    return
+
+                elif session.exclude_mode:
+                    try:
+                        index = get_group_index()
+                        if re.fullmatch(r'[\d\s,-]+', text_message):
+                            ids = session.group_ids or index.ids
+                            numbers = parse_selection(text_message, len(ids))
+                            exclude_groups([ids[number - 1] for number in numbers])
+                            send_excluded_summary(user_id, index)
+                            send_txt_message(user_id, 'Tap Done on the list when you are finished.')
                         else:
-                            send_txt_message(user_id,"Invalid password. Please try again:")
-                        return jsonify({'status': 'ok'})
+                            text, keyboard = render_group_search(index, text_message.strip())
+                            session.group_ids = index.ids
+                            telegram_call('sendMessage', {'chat_id': user_id, 'text': text, 'reply_markup': {'inline_keyboard': keyboard}})
 
-                    elif exclude_op['exclude_mode']:
+                    except Exception as e:
+                        send_txt_message(user_id, f"Error: {e} occurred while excluding selected groups from the main broadcast list")
+                    return
+                
+                elif session.broadcast_mode:
+
+                    if text_message == '3':
                         try:
-                            list_of_strings = text_message.split(',')
-                            
-                            list_of_numbers = [int(num) - 1 for num in list_of_strings]
-                            keys_list = list(exclude_op['groups_list'].keys())
-
-                            for index in list_of_numbers:
-                                db.collection('WappSender').document('exclude_user').update({
-                                    'ids': fs.ArrayUnion([keys_list[index]])
-                                })
-                                
-                            # Construct excluded groups message
-                            excluded_groups = ''
-                            get_excluded_users.cache_clear()
-                            for group in get_excluded_users():
-                                excluded_groups += exclude_op['groups_list'][group] + '\n'
-
-                            send_txt_message(user_id, f'Excluded groups are:\n{excluded_groups.strip()}')
-                            exclude_op['exclude_mode'] = False
+                            broadcast(['+917020805020'],session.content,session)
+                            send_txt_message(user_id, 'The message has been successfully sent to Aditya.')
+                            session.broadcast_mode = False
+                        except Exception as e:
+                            clear_content(session)
+                            send_txt_message(user_id, f'Error: {e} occurred while broadcasting content to Aditya')
+                        return
 
+                    elif text_message == '1':
+                        try:
+                            target_list = list(get_groups_dict().keys())
+                            reset_message_ids(user_id)
+                            executor.submit(send_in_background, target_list, session.content, session, 'The message has been successfully sent to all groups.')
+                            send_txt_message(user_id, 'Request received!.')
                         except Exception as e:
-                            send_txt_message(user_id, f"Error: {e} occurred while excluding selected groups from the main broadcast list")
-                        return jsonify({'status': 'ok'})
+                            clear_content(session)
+                            send_txt_message(user_id, f'Error: {e} occurred while broadcasting content to all groups')
+                        return
                     
-                    elif broadcast_op['broadcast_mode']:
-
-                        if text_message == '3':
-                            try:
-                                broadcast(['+917020805020'],upload_content_op['content'],user_id)
-                                send_txt_message(user_id, 'The message has been successfully sent to Aditya.')
-                                broadcast_op['broadcast_mode'] = False
-                            except Exception as e:
-                                clear_content()
-                                send_txt_message(user_id, f'Error: {e} occurred while broadcasting content to Aditya')
-                            return jsonify({'status': 'ok'})
-
-                        elif text_message == '1':
-                            try:
-                                target_list = list(get_groups_dict().keys())
-                                doc_message = db.collection('WappSender').document('message-ids')
-                                doc_message.update({'ids': []})
-                                executor.submit(send_in_background, target_list, upload_content_op['content'], user_id, 'The message has been successfully sent to all groups.')
+                    elif text_message == '2':
+                        try:
+                            excluded_users=get_excluded_users()                             
+                            if excluded_users:
+                                target_list = [id for id in get_groups_dict().keys() if id not in excluded_users]
+                                reset_message_ids(user_id)
+                                executor.submit(send_in_background, target_list, session.content, session, 'The message has been successfully sent to selected groups.')
                                 send_txt_message(user_id, 'Request received!.')
-                            except Exception as e:
-                                clear_content()
-                                send_txt_message(user_id, f'Error: {e} occurred while broadcasting content to all groups')
-                            return jsonify({'status': 'ok'})
-                        
-                        elif text_message == '2':
-                            try:
-                                excluded_users=get_excluded_users()                             
-                                if excluded_users:
-                                    target_list = [id for id in get_groups_dict().keys() if id not in excluded_users]
-                                    doc_message = db.collection('WappSender').document('message-ids')
-                                    doc_message.update({'ids': []})
-                                    executor.submit(send_in_background, target_list, upload_content_op['content'], user_id, 'The message has been successfully sent to selected groups.')
-                                    send_txt_message(user_id, 'Request received!.')
-                                else:
-                                    get_excluded_users.cache_clear()
-                                    send_txt_message(user_id, 'Please use the /exclude_users command to select the groups you wish to exclude from broadcasting.')
-                                    broadcast_op['broadcast_mode'] = False
-                            except Exception as e:
-                                clear_content()
-                                send_txt_message(user_id, f'Error: {e} occurred while broadcasting content to selected groups')
-                            return jsonify({'status': 'ok'})
-                        
-                    elif upload_content_op['upload_content_mode']:
-                        upload_content_op['content']['text']=text_message
-                        send_txt_message(user_id,'Text message received!')
-                        return jsonify({'status': 'ok'})
+                            else:
+                                get_excluded_users.cache_clear()
+                                send_txt_message(user_id, 'Please use the /exclude_users command to select the groups you wish to exclude from broadcasting.')
+                                session.broadcast_mode = False
+                        except Exception as e:
+                            clear_content(session)
+                            send_txt_message(user_id, f'Error: {e} occurred while broadcasting content to selected groups')
+                        return
+
+                    elif schedule_pattern.fullmatch(text_message.strip()):
+                        try:
+                            audience, run_at, window = parse_schedule(text_message)
+                            if audience == '2' and not get_excluded_users():
+                                send_txt_message(user_id, 'Please use the /exclude_users command to select the groups you wish to exclude from broadcasting.')
+                                session.broadcast_mode = False
+                                return
+                            schedule_id = create_schedule(user_id, audience, session.content, run_at, window)
+                            clear_content(session)
+                            send_txt_message(user_id, f'Broadcast {schedule_id} scheduled for {format_schedule(run_at, window)}.\nUse /cancel_{schedule_id} to cancel it.')
+                        except Exception as e:
+                            send_txt_message(user_id, f'Error: {e} occurred while scheduling the broadcast')
+                        return
                     
-                    else:
-                        send_txt_message(user_id, 'not relevant message')
+                elif session.upload_content_mode:
+                    session.content['text']=text_message
+                    send_txt_message(user_id,'Text message received!')
+                    return
                 
-                elif text_message == '/upload_content':
-                    if user_id not in login_op['login_users']:
-                        send_txt_message(user_id,"Please log in first using /login.")
-                        return jsonify({'status': 'ok'})
-                    clear_content()
-                    send_txt_message(user_id,'To send photos, videos, documents, or text messages, please enter the media or text you would like to broadcast.')
-                    upload_content_op['upload_content_mode']=True
-                    return jsonify({'status': 'ok'})
+                else:
+                    send_txt_message(user_id, 'not relevant message')
+            
+            elif text_message == '/upload_content':
+                if user_id not in login_op['login_users']:
+                    send_txt_message(user_id,"Please log in first using /login.")
+                    return
+                clear_content(session)
+                send_txt_message(user_id,'To send photos, videos, documents, or text messages, please enter the media or text you would like to broadcast.')
+                session.upload_content_mode=True
+                return
 
-                elif text_message == '/clear_content':
+            elif text_message == '/clear_content':
+                if user_id not in login_op['login_users']:
+                    send_txt_message(user_id,"Please log in first using /login.")
+                    return
+                clear_content(session)
+                send_txt_message(user_id,'The media list has been successfully cleared.')
+                return
+
+            elif text_message == '/broadcast':
+                if len(session.content['files'])==0 and not session.content.get('uploads') and 'text' not in session.content:
+                    send_txt_message(user_id,"No content has been uploaded yet. Please use the /upload_content command to upload content before proceeding with the broadcast.")
+                    return
+                if session.content.get('uploads'):
+                    rejected = preflight_content(session.content)
+                    if rejected:
+                        send_txt_message(user_id,'These files failed the pre-flight check and were removed:\n' + '\n'.join(rejected))
+                    if len(session.content['files'])==0 and 'text' not in session.content:
+                        send_txt_message(user_id,"No content is left to broadcast. Please upload it again with /upload_content.")
+                        return
+                session.upload_content_mode=False
+                session.exclude_mode=False
+                send_txt_message(user_id,'1. Send a message to all groups\n2. Send a message to selected groups\n3. Send a message to Aditya\n\n'
+                                 'To schedule 1 or 2, add a time and/or a window, e.g. "1 at 18:30", "2 in 2h" or "1 at 09:00 over 30m".')
+                session.broadcast_mode=True
+                return
+            
+            elif text_message == "/show_status":
+                try:
                     if user_id not in login_op['login_users']:
                         send_txt_message(user_id,"Please log in first using /login.")
-                        return jsonify({'status': 'ok'})
-                    clear_content()
-                    send_txt_message(user_id,'The media list has been successfully cleared.')
-                    return jsonify({'status': 'ok'})
-
-                elif text_message == '/broadcast':
-                    if len(upload_content_op['content']['files'])==0 and  'text' not in upload_content_op['content']:
-                        send_txt_message(user_id,"No content has been uploaded yet. Please use the /upload_content command to upload content before proceeding with the broadcast.")
-                        return jsonify({'status': 'ok'})
-                    upload_content_op['upload_content_mode']=False
-                    send_txt_message(user_id,'1. Send a message to all groups\n2. Send a message to selected groups\n3. Send a message to Aditya')
-                    broadcast_op['broadcast_mode']=True
-                    return jsonify({'status': 'ok'})
-                
-                elif text_message == "/show_status":
-                    try:
-                        if user_id not in login_op['login_users']:
-                            send_txt_message(user_id,"Please log in first using /login.")
-                        else:
-                            txt_message=get_statistics()
-                            send_txt_message(user_id,txt_message)
-                    except Exception as e:
-                        send_txt_message(user_id, f'Error: {e} occurred while /show_status command')
-                    return jsonify({'status': 'ok'})
-                
-                elif text_message == "/login":
-                    if user_id in login_op['login_users']:
-                        send_txt_message(user_id,"You are already logged in.")
-                        return jsonify({'status': 'ok'})
-                    send_txt_message(user_id,'Please enter the password to login:')
-                    login_op['login_mode']=True
-                    return jsonify({'status': 'ok'})
-
-                elif text_message == "/start":
-                    if not user_id in login_op['login_users']:
-                        send_txt_message(user_id, "Hello! I am WappSender,\nI am here to help you with WhatsApp broadcasting.\nTo get started, please /login to use the bot.")
+                    elif delivery_op['enabled']:
+                        send_txt_message(user_id,get_delivery_status(user_id))
                     else:
-                        send_txt_message(user_id,"Welcome back! You are already logged in.")
-                    return jsonify({'status': 'ok'})
-                    
-                elif text_message == '/exclude_users':
-                    try:
-                        if user_id not in login_op['login_users']:
-                            send_txt_message(user_id,"Please log in first using /login.")
-                            return jsonify({'status': 'ok'})
-                        exclude_op['groups_list']=get_groups_dict()   
-                        output_string_1 = ''
-                        output_string_2=''
-                        # Building the output string
-                        for index, value in enumerate(exclude_op['groups_list'].values()):
-                            if index<100:
-                                output_string_1 += f"{index+1}:  {value}\n"
-                            else:
-                                output_string_2 += f"{index+1}:  {value}\n"
-                        exclude_op['exclude_mode']=True
-                        send_txt_message(user_id,output_string_1)
-                        send_txt_message(user_id,output_string_2)
-                        send_txt_message(user_id,'Please provide the indices of the groups you wish to exclude from the broadcast, separated by commas (e.g., 1,2,3).')
-                    except Exception as e:
-                        send_txt_message(user_id, f"Error: {e} occurred while /exclude_users command.")
-                    return jsonify({'status': 'ok'})      
+                        txt_message=get_statistics()
+                        send_txt_message(user_id,txt_message)
+                except Exception as e:
+                    send_txt_message(user_id, f'Error: {e} occurred while /show_status command')
+                return
+            
+            elif text_message == "/schedules":
+                if user_id not in login_op['login_users']:
+                    send_txt_message(user_id,"Please log in first using /login.")
+                    return
+                schedules = list_schedules(user_id)
+                if not schedules:
+                    send_txt_message(user_id,'No broadcasts are scheduled.')
+                    return
+                lines = [f"{schedule_id}: {'all' if audience == '1' else 'selected'} groups at {format_schedule(run_at, window)} /cancel_{schedule_id}"
+                         for schedule_id, audience, run_at, window in schedules]
+                send_txt_message(user_id,'Scheduled broadcasts:\n' + '\n'.join(lines))
+                return
 
-                elif text_message == "/terminate":
-                    try:
-                        broadcast_op['main_loop_mood'] = True
-                        executor.submit(terminate, user_id)
-                        send_txt_message(user_id,'Termination process initiated!!!!')
-                    except Exception as e:
-                        send_txt_message(user_id, f'Error: {e} occurred while /terminate command')
-                        clear_content()
-                    return jsonify({'status': 'ok'})
-                
+            elif text_message == "/login":
+                if user_id in login_op['login_users']:
+                    send_txt_message(user_id,"You are already logged in.")
+                    return
+                send_txt_message(user_id,'Please enter the password to login:')
+                session.login_mode=True
+                return
+
+            elif text_message == "/start":
+                if not user_id in login_op['login_users']:
+                    send_txt_message(user_id, "Hello! I am WappSender,\nI am here to help you with WhatsApp broadcasting.\nTo get started, please /login to use the bot.")
                 else:
-                    send_txt_message(user_id, 'not relevant message')       
+                    send_txt_message(user_id,"Welcome back! You are already logged in.")
+                return
+                
+            elif text_message == '/exclude_users':
+                try:
+                    if user_id not in login_op['login_users']:
+                        send_txt_message(user_id,"Please log in first using /login.")
+                        return
+                    index = get_group_index()
+                    session.group_ids = index.ids
+                    text, keyboard = render_group_page(index, 0)
+                    session.exclude_mode=True
+                    telegram_call('sendMessage', {'chat_id': user_id, 'text': text, 'reply_markup': {'inline_keyboard': keyboard}})
+                    send_txt_message(user_id,'Tap a number to exclude or include that group, send numbers or ranges to exclude several (e.g., 1-40,55), or send part of a name to search.')
+                except Exception as e:
+                    send_txt_message(user_id, f"Error: {e} occurred while /exclude_users command.")
+                return      
 
+            elif text_message == "/terminate":
+                try:
+                    session.main_loop_mood = True
+                    executor.submit(terminate, session)
+                    send_txt_message(user_id,'Termination process initiated!!!!')
+                except Exception as e:
+                    send_txt_message(user_id, f'Error: {e} occurred while /terminate command')
+                    clear_content(session)
+                return
+            
             else:
-                if text_message == "/show_status" :
-                    send_txt_message(user_id, f"{broadcast_op['group_count']}/{broadcast_op['groups_len']}")
-                    return jsonify({'status': 'ok'})
-                
-                elif text_message == "/terminate":
-                    broadcast_op['terminate']=True
-                    return jsonify({'status': 'ok'})  
-                
-                else:
-                    send_txt_message(user_id, 'not relevant message')            
-        
+                send_txt_message(user_id, 'not relevant message')       
+
         else:
-            send_txt_message(user_id, 'not relevant message')   
+            if text_message == "/show_status" :
+                txt_message = f"{session.group_count}/{session.groups_len}"
+                if delivery_op['enabled']:
+                    txt_message += f"\n\n{get_delivery_status(user_id, limit=1)}"
+                send_txt_message(user_id, txt_message)
+                return
+            
+            elif text_message == "/terminate":
+                session.terminate=True
+                return  
+            
+            else:
+                send_txt_message(user_id, 'not relevant message')            
     
+    else:
+        send_txt_message(user_id, 'not relevant message')   
+
+def update_chat_id(update:dict):
+    if 'message' in update:
+        return update['message']['chat']['id']
+    if 'callback_query' in update and 'message' in update['callback_query']:
+        return update['callback_query']['message']['chat']['id']
+    return None
+
+def enqueue_update(update:dict):
+    """Queue an update behind the chat's earlier ones, dropping updates Telegram already delivered."""
+    chat_id = update_chat_id(update)
+    if chat_id is None:
+        return False
+    update_id = update.get('update_id')
+    with update_lock:
+        update_op['received'] += 1
+        if update_id is not None:
+            if update_id in update_op['seen']:
+                update_op['duplicates'] += 1
+                return False
+            update_op['seen'][update_id] = True
+            if len(update_op['seen']) > update_op['dedup_size']:
+                update_op['seen'].popitem(last=False)
+        queue = update_op['queues'].get(chat_id)
+        idle = queue is None
+        if idle:
+            queue = update_op['queues'][chat_id] = deque()
+        queue.append((time.monotonic(), update))
+    if idle:
+        update_executor.submit(dispatch_updates, chat_id)
+    return True
+
+def dispatch_updates(chat_id):
+    """Handle a chat's queued updates one at a time, in arrival order, until its queue is empty."""
+    while True:
+        with update_lock:
+            queue = update_op['queues'][chat_id]
+            if not queue:
+                del update_op['queues'][chat_id]
+                return
+            received_at, update = queue[0]
+        started_at = time.monotonic()
+        failed = False
+        try:
+            session = get_session(chat_id)
+            with session.lock:
+                handle_update(session, update)
+                save_session(session)
+        except Exception:
+            failed = True
+            logging.exception(f"update {update.get('update_id')} failed - in dispatch_updates({chat_id})")
+        finished_at = time.monotonic()
+        with update_lock:
+            # pop only once handled, so the chat stays marked busy and new updates queue behind this one
+            queue.popleft()
+            update_op['failed' if failed else 'processed'] += 1
+            update_op['wait_seconds'] += started_at - received_at
+            update_op['duration_seconds'] += finished_at - received_at
+            update_op['latency_counts'][bisect_left(http_op['latency_buckets'], finished_at - received_at)] += 1
+
+def get_update_stats():
+    with update_lock:
+        labels = [str(bucket) for bucket in http_op['latency_buckets']] + ['+Inf']
+        handled = update_op['processed'] + update_op['failed']
+        return {
+            'queued': sum(len(queue) for queue in update_op['queues'].values()),
+            'chats': len(update_op['queues']),
+            'received': update_op['received'],
+            'duplicates': update_op['duplicates'],
+            'processed': update_op['processed'],
+            'failed': update_op['failed'],
+            'average_wait_seconds': round(update_op['wait_seconds'] / handled, 3) if handled else 0.0,
+            'latency_seconds': dict(zip(labels, update_op['latency_counts'])),
+        }
+
+@app.route('/', methods=['POST'])
+def webhook_post():
+    # acknowledge straight away, Telegram redelivers updates whose webhook call is slow to answer
+    enqueue_update(request.json)
     return jsonify({'status': 'ok'})
 
-@app.route('/health', methods=['GET'])
-def health_check():
-    return jsonify({'status': 'ok', 'message': 'Service is healthy'}), 200
+@app.route('/ultramsg', methods=['POST'])
+def ultramsg_webhook():
+    if not delivery_op['enabled']:
+        abort(404)
+    if not delivery_authorized(request.args.get('token')):
+        abort(403)
+    record_delivery(request.get_json(silent=True) or {})
+    return jsonify({'status': 'ok'})
 
-@app.route('/clear', methods=['GET'])
-def cache_clear():
+@app.route('/media/<name>', methods=['GET', 'HEAD'])
+def media_file(name):
+    if not re.fullmatch(r'[0-9a-f]{64}(\.[0-9a-z]+)?', name):
+        abort(404)
+    return send_from_directory(os.path.abspath(media_op['cache_dir']), name, conditional=True, max_age=86400)
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+def health_status() -> dict:
+    caches = {name: cache.cache_stats() for name, cache in cache_op['caches'].items()}
+    instances = [{'id': inst.id, 'connected': inst.connected, 'circuit': inst.breaker.state, 'queue': inst.queue, 'groups': len(inst.groups)} for inst in instance_pool]
+    return {'status': 'ok', 'message': 'Service is healthy', 'http': get_http_stats(), 'cache': caches, 'instances': instances,
+            'updates': get_update_stats()}
+
+def reload_caches() -> dict:
+    """Drop the cached groups and exclusions and load them again."""
     try:
         get_groups_dict.cache_clear()
         get_excluded_users.cache_clear()
         excluded_user_var=get_excluded_users()
         groups_var=get_groups_dict()
-        return jsonify({'Excluded_Users': excluded_user_var, 'WhatsappGroups': groups_var}), 200
+        return {'Excluded_Users': sorted(excluded_user_var), 'WhatsappGroups': groups_var}
     except Exception as e:
-        return jsonify({'error':str(e)}), 200
+        return {'error':str(e)}
+
+def warm_up():
+    """Build the Firestore client and fill the exclusions and groups caches ahead of the first update."""
+    steps = [('firestore', get_db), ('exclusions', get_excluded_users)]
+    if warmup_op['groups']:
+        steps.append(('groups', get_groups_dict))
+    try:
+        for name, step in steps:
+            try:
+                step()
+                warmup_op['errors'].pop(name, None)
+            except Exception as e:
+                warmup_op['errors'][name] = str(e)
+                logging.warning(f'{e} - while warming up {name}')
+        # the groups directory is only a head start, a broadcast still loads it when UltraMsg comes back
+        if not warmup_op['errors'].keys() - {'groups'} and not warmup_op['ready']:
+            warmup_op['ready_seconds'] = round(time.monotonic() - warmup_op['started_at'], 3)
+            warmup_op['ready'] = True
+    finally:
+        warmup_op['running'] = False
+
+def start_warm_up():
+    with warmup_lock:
+        if warmup_op['running'] or warmup_op['ready']:
+            return
+        warmup_op['running'] = True
+    executor.submit(warm_up)
+
+def readiness_status() -> dict:
+    """Whether this process can serve updates without a cold Firestore client; polling it starts the warm-up if it isn't running."""
+    if not warmup_op['ready']:
+        start_warm_up()
+    return {'ready': warmup_op['ready'], 'ready_seconds': warmup_op['ready_seconds'],
+            'firestore': firestore_op['client'] is not None,
+            'groups': get_groups_dict.cache_stats()['age'] is not None,
+            'instances': any_instance_available(), 'errors': dict(warmup_op['errors'])}
+
+@app.route('/health', methods=['GET'])
+def health_check():
+    return jsonify(health_status()), 200
+
+@app.route('/ready', methods=['GET'])
+def ready_check():
+    status = readiness_status()
+    return jsonify(status), 200 if status['ready'] else 503
+
+@app.route('/clear', methods=['GET'])
+def cache_clear():
+    return jsonify(reload_caches()), 200
+
+def claim_job_resume() -> bool:
+    """Let only one process per jobs database resume jobs, so two processes sharing it (e.g. old and new during a deploy) don't both restart the same broadcast."""
+    try:
+        import fcntl
+    except ImportError:
+        return True
+    lock_file = open(f"{os.getenv('jobs_db', 'wappsender.db')}.resume.lock", 'w')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return False
+    job_op['resume_lock'] = lock_file  # held for the life of the process
+    return True
+
+init_jobs_db()
+prune_deliveries()
+if media_op['relay_url']:
+    executor.submit(prune_media_cache)
+if delivery_op['enabled'] and not delivery_op['token']:
+    logging.warning('delivery_webhook=1 but delivery_webhook_token is empty, /ultramsg refuses every event until it is set')
+if warmup_op['enabled']:
+    start_warm_up()
+if os.getenv('resume_jobs', '1') == '1' and claim_job_resume():
+    executor.submit(resume_jobs)
+load_schedules()
+threading.Thread(target=run_scheduler, name='scheduler', daemon=True).start()
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=8000)
\ No newline at end of file